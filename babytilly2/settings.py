@@ -45,6 +45,7 @@ env = environ.Env(
     AWS_STORAGE_BUCKET_NAME=(str, "babytilly2"),
     AWS_DEFAULT_REGION=(str, "us-east-1"),
     REDIS_URL=(str, None),
+    CATALOG_KEYSET_PAGINATION=(bool, False),
 )
 
 EMAIL_BACKEND = "django_ses.SESBackend"
@@ -231,6 +232,8 @@ THUMBNAIL_SIZE = {
     "complaint": "200",
 }
 PAGINATOR = [10, 25, 50, 100]
+# paginate catalog listings with a cursor instead of page numbers
+CATALOG_KEYSET_PAGINATION = env("CATALOG_KEYSET_PAGINATION")
 
 if BROKER_URL := env("REDIS_URL"):
     CELERY_BROKER_URL = BROKER_URL
@@ -1,8 +1,9 @@
-import io
+from functools import partial
 
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as DefaultUserAdmin
-from django.http import FileResponse
+from django.db import transaction
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.urls import path
 from django.utils.safestring import mark_safe
@@ -10,6 +11,7 @@ from django.utils.translation import gettext_lazy
 from mptt.admin import MPTTModelAdmin
 from sorl.thumbnail.admin import AdminImageMixin
 
+from commercial.catalog import bump_catalog_version, forget_excluded_category_ids
 from commercial.filters import ArticlePublishedFilter, CategoryPublishedFilter, ArticleNewFilter, ArticleSaleFilter, \
     CategoryDepartamentFilter, ArticleDepartamentFilter
 from commercial.forms import ArticleAdminForm, MessageForm
@@ -19,6 +21,7 @@ from commercial.models import (
     CategoryProperties,
     ArticleProperties,
     ArticleImage,
+    Order,
     OrderItem,
     DepartamentSale,
     UserDebs,
@@ -27,7 +30,8 @@ from commercial.models import (
     MessageAttachment,
     Complaint,
 )
-from commercial.tasks import send_message_mail
+from commercial.search import update_search_vectors
+from commercial.tasks import send_message_mail, build_xml_feed
 
 
 class ProfileAdmin(admin.StackedInline):
@@ -90,6 +94,17 @@ class DepartamentAdmin(admin.ModelAdmin):
     def has_delete_permission(self, request, obj=None):
         return request.user.is_superuser
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change and "search_config" in form.changed_data:
+            update_search_vectors(obj)
+            transaction.on_commit(partial(bump_catalog_version, obj.pk))
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        if any(formset.has_changed() for formset in formsets):
+            Order.update_open_totals(user__profile__departament=form.instance)
+
     def get_urls(self):
         urls = super().get_urls()
         department_urls = [
@@ -99,12 +114,9 @@ class DepartamentAdmin(admin.ModelAdmin):
 
     def export_xml(self, request, pk: int):
         departament = get_object_or_404(Departament, pk=pk)
-        buffer = io.BytesIO()
-        tree = export_department_to_xml(departament)
-
-        tree.write(buffer, encoding="utf-8")
-        buffer.seek(0)
-        return FileResponse(buffer, as_attachment=True, filename=f"department-{departament.country.name}.xml")
+        response = StreamingHttpResponse(export_department_to_xml(departament), content_type="text/xml")
+        response["Content-Disposition"] = f'attachment; filename="department-{departament.country.name}.xml"'
+        return response
 
 
 class DeliveryAdmin(admin.ModelAdmin):
@@ -127,6 +139,19 @@ class CategoryAdmin(MPTTModelAdmin):
         if property:
             return property.name
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        for departament_id in form.instance.categoryproperties_set.values_list("departament_id", flat=True):
+            bump_catalog_version(departament_id)
+            build_xml_feed.delay_on_commit(departament_id)
+
+    def delete_model(self, request, obj):
+        departament_ids = list(obj.categoryproperties_set.values_list("departament_id", flat=True))
+        super().delete_model(request, obj)
+        for departament_id in departament_ids:
+            bump_catalog_version(departament_id)
+            build_xml_feed.delay_on_commit(departament_id)
+
     def get_queryset(self, request):
         self.request = request
         queryset = super(CategoryAdmin, self).get_queryset(request)
@@ -179,6 +204,18 @@ class ArticleAdmin(admin.ModelAdmin):
     def save_related(self, request, form, formsets, change):
         super().save_related(request, form, formsets, change)
         form.save_images(form.instance)
+        for departament in Departament.objects.filter(articleproperties__article=form.instance):
+            update_search_vectors(departament, [form.instance.pk])
+        for departament_id in form.instance.articleproperties_set.values_list("departament_id", flat=True):
+            bump_catalog_version(departament_id)
+            build_xml_feed.delay_on_commit(departament_id)
+
+    def delete_model(self, request, obj):
+        departament_ids = list(obj.articleproperties_set.values_list("departament_id", flat=True))
+        super().delete_model(request, obj)
+        for departament_id in departament_ids:
+            bump_catalog_version(departament_id)
+            build_xml_feed.delay_on_commit(departament_id)
 
     @admin.display(description=gettext_lazy("name"), ordering="articleproperties__name")
     def article_name(self, obj):
@@ -218,6 +255,13 @@ class UserAdmin(DefaultUserAdmin):
         ),
     )
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        if hasattr(form.instance, "profile"):
+            transaction.on_commit(partial(forget_excluded_category_ids, form.instance.profile.pk))
+        if any(formset.has_changed() for formset in formsets):
+            Order.update_open_totals(user=form.instance)
+
     def get_readonly_fields(self, request, obj=None):
         readonly_fields = super(UserAdmin, self).get_readonly_fields(request, obj=obj)
         if not request.user.is_superuser:
@@ -232,7 +276,7 @@ class UserAdmin(DefaultUserAdmin):
 
 
 class ImportPriceAdmin(admin.ModelAdmin):
-    readonly_fields = ["imported_at", "user"]
+    readonly_fields = ["imported_at", "user", "result"]
     list_display = ["imported_at", "user", "departament"]
     list_filter = ["user", "departament"]
     autocomplete_fields = ["departament", "user"]
@@ -244,7 +288,7 @@ class ImportPriceAdmin(admin.ModelAdmin):
 
 
 class ImportDebtsAdmin(admin.ModelAdmin):
-    readonly_fields = ["imported_at", "user"]
+    readonly_fields = ["imported_at", "user", "result"]
     list_display = ["imported_at", "user"]
     list_filter = ["user"]
     ordering = ["-imported_at"]
@@ -287,6 +331,10 @@ class OrderAdmin(admin.ModelAdmin):
     def has_delete_permission(self, request, obj=None):
         return request.user.is_superuser
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        form.instance.update_totals()
+
     def get_readonly_fields(self, request, obj=None):
         readonly_fields = super(OrderAdmin, self).get_readonly_fields(request, obj)
         if obj and not request.user.is_superuser:
@@ -0,0 +1,154 @@
+import base64
+import hashlib
+import json
+import typing
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import models
+from django.utils.functional import cached_property
+
+from commercial.models import Departament
+
+EXCLUDED_CATEGORIES_KEY = "excluded-categories:{profile_id}"
+# cached catalog data is keyed by the catalog version, the timeout only bounds leftovers
+CATALOG_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def bump_catalog_version(departament_id: int):
+    # stored in the database, so web and worker processes see it together with the changed catalog
+    Departament.objects.filter(pk=departament_id).update(catalog_version=models.F("catalog_version") + 1)
+
+
+def get_catalog_count(departament: Departament, key: str, queryset: models.QuerySet) -> int:
+    cache_key = f"catalog-count:{departament.pk}:{key}:{departament.catalog_version}"
+    count = cache.get(cache_key)
+    if count is None:
+        count = queryset.order_by().count()
+        cache.set(cache_key, count, CATALOG_CACHE_TIMEOUT)
+    return count
+
+
+def get_excluded_category_ids(profile) -> typing.List[str]:
+    # forgotten by the user admin when the exclusions change
+    return cache.get_or_set(
+        EXCLUDED_CATEGORIES_KEY.format(profile_id=profile.pk),
+        lambda: sorted(profile.excluded_categories.values_list("id", flat=True)),
+        CATALOG_CACHE_TIMEOUT,
+    )
+
+
+def forget_excluded_category_ids(profile_id: int):
+    cache.delete(EXCLUDED_CATEGORIES_KEY.format(profile_id=profile_id))
+
+
+def get_menu_cache_key(profile) -> str:
+    # Profiles of one departament excluding the same categories share the menu.
+    excluded = ",".join(str(category_id) for category_id in get_excluded_category_ids(profile))
+    digest = hashlib.md5(excluded.encode()).hexdigest()
+    return f"{profile.departament_id}:{digest}:{profile.departament.catalog_version}"
+
+
+class CachedCountPaginator(Paginator):
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        if count is not None:
+            self.count = count
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class KeysetPage:
+    # Rows come from WHERE (key) > (cursor), so a deep page costs the same as the first one.
+    def __init__(self, object_list, paginator: "KeysetPaginator", next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+    def has_other_pages(self) -> bool:
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    # The last ordering field must be unique, all fields share one direction.
+    def __init__(self, queryset: models.QuerySet, per_page: int, ordering: typing.List[str], count=None):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = ordering
+        self.descending = ordering[0].startswith("-")
+        self.fields = [name.lstrip("-") for name in ordering]
+        self._count = count
+
+    @cached_property
+    def count(self) -> int:
+        if self._count is not None:
+            return self._count
+        return self.queryset.order_by().count()
+
+    def encode_cursor(self, obj, before: bool = False) -> str:
+        values = [str(getattr(obj, name)) for name in self.fields]
+        data = json.dumps(["b" if before else "a", values]).encode()
+        return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+    def decode_cursor(self, cursor: str) -> typing.Tuple[bool, list]:
+        try:
+            data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            direction, values = json.loads(data)
+            if direction not in ("a", "b") or len(values) != len(self.fields):
+                raise ValueError(cursor)
+            model = self.queryset.model
+            values = [model._meta.get_field(name).to_python(value) for name, value in zip(self.fields, values)]
+        except (ValueError, TypeError, ValidationError) as e:
+            raise InvalidCursor(cursor) from e
+        return direction == "b", values
+
+    def _seek(self, values: list, forward: bool) -> models.Q:
+        # expands the row comparison (f1, f2, f3) > (v1, v2, v3) into indexable predicates
+        lookup = "gt" if forward != self.descending else "lt"
+        condition = models.Q()
+        for index, name in enumerate(self.fields):
+            term = models.Q(**{f"{name}__{lookup}": values[index]})
+            for previous_name, previous_value in zip(self.fields[:index], values[:index]):
+                term &= models.Q(**{previous_name: previous_value})
+            condition |= term
+        return condition
+
+    def page(self, cursor: typing.Optional[str] = None) -> KeysetPage:
+        queryset = self.queryset.order_by(*self.ordering)
+        before = False
+        if cursor:
+            before, values = self.decode_cursor(cursor)
+            if before:
+                reverse_ordering = [name[1:] if name.startswith("-") else f"-{name}" for name in self.ordering]
+                queryset = self.queryset.order_by(*reverse_ordering)
+            queryset = queryset.filter(self._seek(values, forward=not before))
+
+        rows = list(queryset[: self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[: self.per_page]
+        if before:
+            rows.reverse()
+
+        next_cursor = previous_cursor = None
+        if rows:
+            if has_more or before:
+                next_cursor = self.encode_cursor(rows[-1])
+            if (has_more and before) or (cursor and not before):
+                previous_cursor = self.encode_cursor(rows[0], before=True)
+        return KeysetPage(rows, self, next_cursor, previous_cursor)
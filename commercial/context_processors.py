@@ -1,15 +1,21 @@
+from commercial.catalog import get_excluded_category_ids, get_menu_cache_key
 from commercial.models import CategoryProperties
 
 
 def root_sections(request):
     categories = []
+    menu_cache_key = ""
     if request.user.is_authenticated and request.user.profile:
+        profile = request.user.profile
+        # the queryset is only evaluated when the cached menu is missing
         categories = CategoryProperties.objects.filter(
-            published=True, departament__id=request.user.profile.departament_id
+            published=True, departament__id=profile.departament_id
         ).exclude(
-            category__in=request.user.profile.excluded_categories.values_list("id", flat=True)
+            category__in=get_excluded_category_ids(profile)
         ).select_related('category').order_by('name', 'category__tree_id', 'category__lft')
+        menu_cache_key = get_menu_cache_key(profile)
 
     return {
-        'categories': categories
+        'categories': categories,
+        'menu_cache_key': menu_cache_key,
     }
@@ -1,18 +1,26 @@
 import csv
 import datetime
+import gzip
 import logging
+import re
 import typing
-import xml.etree.ElementTree as ET
 from collections import defaultdict
+from decimal import Decimal
 from io import BytesIO, StringIO
+from xml.sax.saxutils import XMLGenerator
 
 from PIL import Image
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
 from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import QuerySet
+from django.utils.encoding import filepath_to_uri
 from django.utils.timezone import now
 
+from commercial.catalog import bump_catalog_version
 from commercial.models import Departament, Category, CategoryProperties, Article, ArticleProperties, Order, Profile, \
-    UserDebs, ArticleImage
+    OrderItem, UserDebs, ArticleImage, XMLFeed
+from commercial.search import update_search_vectors
 
 logger = logging.getLogger(__name__)
 
@@ -70,165 +78,527 @@ def get_thumbnail_url(image, size):
     return thumb_url
 
 
-def get_or_create_category(
-        category_id: str, category_name: str, departament: Departament, parent: Category = None
-) -> Category:
-    category, created = Category.objects.get_or_create(pk=category_id)
-    category_property, created = CategoryProperties.objects.get_or_create(
-        category=category,
-        departament=departament
+def get_media_url_prefix() -> str:
+    # Lets callers build many URLs without a storage call per file.
+    return default_storage.url('')
+
+
+ADD_TO_ORDER_SQL = """
+    WITH upserted AS (
+        INSERT INTO {order_item} (
+            order_id, article_id, count, name, volume, weight, price, full_price, barcode, company, main_image_url
+        )
+        SELECT %(order_id)s, ap.article_id, item.count, ap.name, ap.volume, ap.weight,
+               CAST(ap.price * (100 - %(sale)s) / 100 AS numeric(10, 3)), ap.price, ap.barcode, ap.company,
+               item.main_image_url
+        FROM unnest(%(article_ids)s::varchar[], %(counts)s::integer[], %(main_image_urls)s::varchar[])
+            AS item(article_id, count, main_image_url)
+        JOIN {article_properties} ap ON ap.article_id = item.article_id AND ap.departament_id = %(departament_id)s
+        ON CONFLICT (order_id, article_id) DO UPDATE SET
+            count = EXCLUDED.count, name = EXCLUDED.name, volume = EXCLUDED.volume, weight = EXCLUDED.weight,
+            price = EXCLUDED.price, full_price = EXCLUDED.full_price, barcode = EXCLUDED.barcode,
+            company = EXCLUDED.company, main_image_url = EXCLUDED.main_image_url
+        RETURNING article_id, count
+    ),
+    untouched AS (
+        SELECT count FROM {order_item}
+        WHERE order_id = %(order_id)s AND article_id NOT IN (SELECT article_id FROM upserted)
     )
-    category_property.name = category_name
-    category_property.published = True
-    category_property.save()
-    if not category.parent == parent:
-        category.parent = parent
-        category.save()
-    return category
-
-
-def do_import_price(csv_file: typing.IO, country: str):
-    field_names = [
-        'id', 'name', 'vendor_code', 'is_category', 'parent_id',
-        'parent_name', 'trade_price', 'retail_price', 'currency', 'length', 'width', 'height',
-        'volume', 'weight', None, None, 'barcode', 'description', 'image_link',
-        'video_link', 'presence', 'site_link', 'company'
-    ]
-    reader = csv.DictReader(csv_file, fieldnames=field_names, delimiter=';')
-    departament = Departament.objects.get(country=country)
-    CategoryProperties.objects.filter(departament=departament).update(published=False)
-    ArticleProperties.objects.filter(departament=departament).update(published=False)
+    SELECT
+        ARRAY(SELECT article_id FROM upserted),
+        (SELECT COUNT(*) FROM upserted) + (SELECT COUNT(*) FROM untouched),
+        COALESCE((SELECT SUM(count) FROM upserted), 0) + COALESCE((SELECT SUM(count) FROM untouched), 0)
+""".format(
+    order_item=OrderItem._meta.db_table,
+    article_properties=ArticleProperties._meta.db_table,
+)
+
+
+def get_main_image_urls(
+    departament_id: int, article_ids: typing.Iterable[str]
+) -> typing.Dict[str, typing.Optional[str]]:
+    media_url = get_media_url_prefix()
+    return {
+        article_id: media_url + filepath_to_uri(main_image) if main_image else None
+        for article_id, main_image in ArticleProperties.objects.filter(
+            departament_id=departament_id, article_id__in=list(article_ids)
+        ).values_list('article_id', 'main_image')
+    }
+
+
+def add_to_order(get_order: typing.Callable[[], Order], user, counts: typing.Dict[str, int]) -> dict:
+    # get_order is called only when some articles exist, so unknown articles never create an order.
+    main_image_urls = get_main_image_urls(user.profile.departament_id, counts)
+    if not main_image_urls:
+        return {'added': [], 'lines': 0, 'quantity': 0}
+    article_ids = list(main_image_urls)
+    with transaction.atomic():
+        order = get_order()
+        params = {
+            'order_id': order.pk,
+            'sale': user.profile.sale,
+            'article_ids': article_ids,
+            'counts': [counts[article_id] for article_id in article_ids],
+            'main_image_urls': [main_image_urls[article_id] for article_id in article_ids],
+            'departament_id': user.profile.departament_id,
+        }
+        with connection.cursor() as cursor:
+            cursor.execute(ADD_TO_ORDER_SQL, params)
+            added, lines, quantity = cursor.fetchone()
+        order.update_totals()
+    return {
+        'added': added,
+        'lines': lines,
+        'quantity': quantity,
+    }
+
+
+MAX_ORDER_COUNT = 2147483647
+
+
+def _parse_order_line(code, count=None) -> typing.Optional[typing.Tuple[str, int]]:
+    code = str(code).strip() if code is not None else ''
+    try:
+        count = int(count) if count not in (None, '') else 1
+    except (TypeError, ValueError):
+        return None
+    if not code or not 0 < count <= MAX_ORDER_COUNT:
+        return None
+    return code, count
+
+
+def parse_order_lines(text: str) -> typing.Tuple[typing.List[typing.Tuple[str, int]], typing.List[str]]:
+    pairs, invalid = [], []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        parts = re.split(r'[;,\t]', line, maxsplit=1)
+        pair = _parse_order_line(parts[0], parts[1].strip() if len(parts) > 1 else '')
+        if pair is None:
+            invalid.append(line)
+        else:
+            pairs.append(pair)
+    return pairs, invalid
+
+
+def parse_order_items(items: list) -> typing.Tuple[typing.List[typing.Tuple[str, int]], typing.List[str]]:
+    pairs, invalid = [], []
+    for item in items:
+        if isinstance(item, dict):
+            pair = _parse_order_line(item.get('code'), item.get('count'))
+        elif isinstance(item, (list, tuple)) and 1 <= len(item) <= 2:
+            pair = _parse_order_line(*item)
+        else:
+            pair = None
+        if pair is None:
+            invalid.append(str(item))
+        else:
+            pairs.append(pair)
+    return pairs, invalid
+
+
+def find_article_codes(queryset: QuerySet, codes: typing.Iterable[str]) -> typing.Dict[str, ArticleProperties]:
+    # One UNION ALL branch per kind of code, so each is served by an index; ids win over barcodes over vendor codes.
+    codes = set(codes)
+    if not codes:
+        return {}
+    queryset = queryset.select_related('article').order_by()
+    rows = queryset.filter(article_id__in=codes).union(
+        queryset.filter(barcode__in=codes),
+        queryset.filter(article__vendor_code__in=codes),
+        all=True,
+    ).order_by('article_id')
+    by_id, by_barcode, by_vendor_code = {}, {}, {}
+    for item in rows:
+        by_id[item.article_id] = item
+        by_barcode.setdefault(item.barcode, item)
+        by_vendor_code.setdefault(item.article.vendor_code, item)
+    found = {}
+    for index in (by_vendor_code, by_barcode, by_id):
+        found.update((code, item) for code, item in index.items() if code in codes)
+    return found
+
+
+def resolve_article_codes(departament_id: int, codes: typing.Iterable[str]) -> typing.Dict[str, str]:
+    queryset = ArticleProperties.objects.filter(departament_id=departament_id).only(
+        'article', 'barcode', 'article__vendor_code'
+    )
+    return {code: item.article_id for code, item in find_article_codes(queryset, codes).items()}
+
+
+def lookup_article_codes(user, codes: typing.Iterable[str]) -> typing.Dict[str, ArticleProperties]:
+    queryset = ArticleProperties.objects.filter(departament_id=user.profile.departament_id).with_user_price(user).only(
+        'article', 'name', 'published', 'price', 'retail_price', 'presence', 'barcode', 'article__vendor_code'
+    )
+    return find_article_codes(queryset, codes)
+
+
+def add_lines_to_order(get_order: typing.Callable[[], Order], user, lines: typing.List[typing.Tuple[str, int]]) -> dict:
+    resolved = resolve_article_codes(user.profile.departament_id, (code for code, count in lines))
+    counts = defaultdict(int)
+    unknown = []
+    for code, count in lines:
+        if code in resolved:
+            counts[resolved[code]] = min(counts[resolved[code]] + count, MAX_ORDER_COUNT)
+        else:
+            unknown.append(code)
+    result = add_to_order(get_order, user, counts)
+    result['unknown'] = unknown
+    return result
+
+
+IMPORT_BATCH_SIZE = 1000
+
+PRICE_FIELD_NAMES = [
+    'id', 'name', 'vendor_code', 'is_category', 'parent_id',
+    'parent_name', 'trade_price', 'retail_price', 'currency', 'length', 'width', 'height',
+    'volume', 'weight', None, None, 'barcode', 'description', 'image_link',
+    'video_link', 'presence', 'site_link', 'company'
+]
+
+# ArticleProperties field -> price list column
+ARTICLE_PROPERTY_COLUMNS = {
+    'name': 'name',
+    'description': 'description',
+    'price': 'trade_price',
+    'retail_price': 'retail_price',
+    'presence': 'presence',
+    'length': 'length',
+    'width': 'width',
+    'height': 'height',
+    'volume': 'volume',
+    'weight': 'weight',
+    'image_link': 'image_link',
+    'video_link': 'video_link',
+    'site_link': 'site_link',
+    'barcode': 'barcode',
+    'company': 'company',
+}
+
+
+def _article_property_values(row: dict) -> dict:
+    values = {}
+    for field_name, column in ARTICLE_PROPERTY_COLUMNS.items():
+        field = ArticleProperties._meta.get_field(field_name)
+        value = row[column]
+        if value == '' and field.null:
+            value = None
+        values[field_name] = field.to_python(value)
+    return values
+
+
+def _read_price_rows(csv_file: typing.IO) -> typing.Tuple[dict, dict]:
+    # Later rows win, the same way repeated saves did when the file was imported row by row.
+    reader = csv.DictReader(csv_file, fieldnames=PRICE_FIELD_NAMES, delimiter=';')
+    categories = {}
+    articles = {}
     for row in reader:
-        is_category = row['is_category'] == '1'
         row_id = str(row['id']).strip()
+        if not row_id:
+            continue
         parent_id = str(row['parent_id']).strip()
-        if is_category:
-            # print(row)
+        if row['is_category'] == '1':
             if parent_id and row['parent_name']:
-                parent = get_or_create_category(parent_id, row['parent_name'], departament)
+                categories[parent_id] = (row['parent_name'], None)
             else:
-                parent = None
-            get_or_create_category(row_id, row['name'], departament, parent=parent)
+                parent_id = None
+            categories[row_id] = (row['name'], parent_id)
         else:
-            # print(row)
-            parent = get_or_create_category(parent_id, row['parent_name'], departament)
-            article_id = row_id
-            article, created = Article.objects.get_or_create(pk=article_id)
-            article.category = parent
-            article.vendor_code = row['vendor_code']
-            article.save()
-            article_property, created = ArticleProperties.objects.get_or_create(
-                article=article,
-                departament=departament
-            )
-            article_property.name = row['name']
-            article_property.description = row['description']
-            article_property.price = row['trade_price']
-            article_property.retail_price = row['retail_price']
-            article_property.presence = row['presence']
+            categories[parent_id] = (row['parent_name'], None)
+            articles[row_id] = row
+    return categories, articles
+
+
+def _has_changes(instance, values: dict) -> bool:
+    for field_name, value in values.items():
+        field = instance._meta.get_field(field_name)
+        current = getattr(instance, field.attname)
+        if field.get_db_prep_save(current, connection) != field.get_db_prep_save(value, connection):
+            return True
+    return False
+
+
+def _get_changed_trees(categories: typing.Dict[str, Category], changed_categories: list) -> typing.Optional[set]:
+    # None means the changes span several trees or add roots, so the whole forest is rebuilt.
+    changed_ids = {category.pk for category in changed_categories}
+    tree_ids = set()
+    for category in changed_categories:
+        root = category
+        path = {category.pk}
+        while root.parent_id is not None:
+            root = categories.get(root.parent_id)
+            if root is None or root.pk in path:
+                return None
+            path.add(root.pk)
+        if root.pk in changed_ids:
+            return None
+        if category.tree_id and category.tree_id != root.tree_id:
+            return None
+        category.tree_id = root.tree_id
+        tree_ids.add(root.tree_id)
+    return tree_ids
+
+
+def _import_categories(categories: dict, departament: Departament) -> typing.Optional[set]:
+    existing_categories = Category.objects.in_bulk(list(categories))
+    new_categories = [
+        # tree fields are filled by the rebuild at the end of the import
+        Category(id=category_id, parent_id=parent_id, lft=0, rght=0, tree_id=0, level=0)
+        for category_id, (name, parent_id) in categories.items() if category_id not in existing_categories
+    ]
+    moved_categories = []
+    for category_id, (name, parent_id) in categories.items():
+        category = existing_categories.get(category_id)
+        if category is not None and category.parent_id != parent_id:
+            category.parent_id = parent_id
+            moved_categories.append(category)
+    existing_categories.update((category.pk, category) for category in new_categories)
+    tree_ids = _get_changed_trees(existing_categories, new_categories + moved_categories)
+
+    with Category.objects.disable_mptt_updates():
+        Category.objects.bulk_create(new_categories, batch_size=IMPORT_BATCH_SIZE)
+        Category.objects.bulk_update(moved_categories, ['parent', 'tree_id'], batch_size=IMPORT_BATCH_SIZE)
+
+    category_properties = {
+        category_property.category_id: category_property
+        for category_property in CategoryProperties.objects.filter(departament=departament)
+    }
+    new_properties = []
+    changed_properties = []
+    for category_id, (name, parent_id) in categories.items():
+        values = {'name': name, 'published': True}
+        category_property = category_properties.get(category_id)
+        if category_property is None:
+            new_properties.append(CategoryProperties(category_id=category_id, departament=departament, **values))
+        elif _has_changes(category_property, values):
+            for field_name, value in values.items():
+                setattr(category_property, field_name, value)
+            changed_properties.append(category_property)
+    CategoryProperties.objects.bulk_create(new_properties, batch_size=IMPORT_BATCH_SIZE)
+    CategoryProperties.objects.bulk_update(changed_properties, ['name', 'published'], batch_size=IMPORT_BATCH_SIZE)
+    CategoryProperties.objects.filter(pk__in=[
+        category_property.pk for category_id, category_property in category_properties.items()
+        if category_property.published and category_id not in categories
+    ]).update(published=False)
+
+    return tree_ids
+
+
+def _import_articles(articles: dict, departament: Departament) -> typing.Dict[str, int]:
+    existing_articles = Article.objects.in_bulk(list(articles))
+    new_articles = []
+    changed_articles = []
+    for article_id, row in articles.items():
+        values = {'category_id': str(row['parent_id']).strip(), 'vendor_code': row['vendor_code']}
+        article = existing_articles.get(article_id)
+        if article is None:
+            new_articles.append(Article(id=article_id, **values))
+        elif _has_changes(article, values):
+            for field_name, value in values.items():
+                setattr(article, field_name, value)
+            changed_articles.append(article)
+    Article.objects.bulk_create(new_articles, batch_size=IMPORT_BATCH_SIZE)
+    Article.objects.bulk_update(changed_articles, ['category', 'vendor_code'], batch_size=IMPORT_BATCH_SIZE)
+
+    article_properties = {
+        article_property.article_id: article_property
+        for article_property in ArticleProperties.objects.filter(departament=departament)
+    }
+    new_properties = []
+    changed_properties = []
+    for article_id, row in articles.items():
+        values = _article_property_values(row)
+        values['published'] = True
+        article_property = article_properties.get(article_id)
+        if article_property is None:
+            new_properties.append(ArticleProperties(article_id=article_id, departament=departament, **values))
+        elif _has_changes(article_property, values):
+            for field_name, value in values.items():
+                setattr(article_property, field_name, value)
+            changed_properties.append(article_property)
+    ArticleProperties.objects.bulk_create(new_properties, batch_size=IMPORT_BATCH_SIZE)
+    ArticleProperties.objects.bulk_update(
+        changed_properties, list(ARTICLE_PROPERTY_COLUMNS) + ['published'], batch_size=IMPORT_BATCH_SIZE
+    )
+    unpublished = ArticleProperties.objects.filter(pk__in=[
+        article_property.pk for article_id, article_property in article_properties.items()
+        if article_property.published and article_id not in articles
+    ]).update(published=False)
+    indexed_article_ids = {article.article_id for article in new_properties + changed_properties}
+    indexed_article_ids.update(article.id for article in new_articles + changed_articles)
+    if indexed_article_ids:
+        update_search_vectors(departament, indexed_article_ids)
+
+    return {
+        'inserted': len(new_properties),
+        'updated': len(changed_properties),
+        'unchanged': len(articles) - len(new_properties) - len(changed_properties),
+        'unpublished': unpublished,
+    }
+
+
+def do_import_price(csv_file: typing.IO, country: str) -> typing.Dict[str, int]:
+    # The file is parsed before any write, so storefront never sees a half imported departament.
+    categories, articles = _read_price_rows(csv_file)
+    with transaction.atomic():
+        # serialize imports of the same departament
+        departament = Departament.objects.select_for_update().get(country=country)
+        tree_ids = _import_categories(categories, departament)
+        result = _import_articles(articles, departament)
+
+        if tree_ids is None:
+            Category.objects.rebuild()
+        else:
+            for tree_id in tree_ids:
+                Category.objects.partial_rebuild(tree_id)
+        bump_catalog_version(departament.pk)
+    logger.info('Price import for %s: %s', departament, result)
+    return result
 
-            article_property.length = row['length']
-            article_property.width = row['width']
-            article_property.height = row['height']
 
-            article_property.volume = row['volume']
-            article_property.weight = row['weight']
+def do_import_novelty(csv_file: typing.IO, departament_id: int) -> dict:
+    return _perform_update_articles(csv_file, departament_id, 'is_new')
 
-            article_property.image_link = row['image_link']
-            article_property.video_link = row['video_link']
-            article_property.site_link = row['site_link']
 
-            article_property.barcode = row['barcode']
-            article_property.company = row['company']
+def do_import_special(csv_file: typing.IO, departament_id: int) -> dict:
+    return _perform_update_articles(csv_file, departament_id, 'is_special')
 
-            article_property.published = True
-            article_property.save()
 
-    Category.objects.rebuild()
+def do_import_debs(csv_file: typing.IO) -> dict:
+    # first profile wins for a shared INN
+    user_ids = dict(Profile.objects.exclude(inn=None).order_by('-pk').values_list('inn', 'user_id'))
+    reader = csv.DictReader(csv_file, fieldnames=('inn', 'document', 'date', 'amount'), delimiter=';')
+    debts = {}
+    unknown_inns = set()
+    for row in reader:
+        inn = row['inn'].strip()
+        user_id = user_ids.get(inn)
+        if user_id is None:
+            unknown_inns.add(inn)
+            continue
+        document = row['document'].strip()
+        debts[(user_id, document)] = UserDebs(
+            user_id=user_id,
+            document=document,
+            date_of_sale=datetime.datetime.strptime(row['date'].strip(), '%d.%m.%Y').date(),
+            amount=Decimal(row['amount'].strip().replace(',', '.')),
+        )
 
+    with transaction.atomic():
+        UserDebs.objects.all().delete()
+        UserDebs.objects.bulk_create(debts.values(), batch_size=IMPORT_BATCH_SIZE)
 
-def do_import_novelty(csv_file: typing.IO, departament_id: int):
-    _perform_update_articles(csv_file, departament_id, 'is_new')
+    result = {
+        'imported': len(debts),
+        'unknown_inn': sorted(unknown_inns),
+    }
+    logger.info('Debts import: %s', result)
+    return result
 
 
-def do_import_special(csv_file: typing.IO, departament_id: int):
-    _perform_update_articles(csv_file, departament_id, 'is_special')
+def _perform_update_articles(csv_file: typing.IO, departament_id: int, field_name: str) -> dict:
+    reader = csv.reader(csv_file, delimiter=';')
+    article_ids = {str(row[0]).strip() for row in reader if row and str(row[0]).strip()}
 
+    queryset = ArticleProperties.objects.filter(departament_id=departament_id)
+    with transaction.atomic():
+        cleared = queryset.filter(**{field_name: True}).exclude(article_id__in=article_ids).update(
+            **{field_name: False}
+        )
+        flagged = queryset.filter(article_id__in=article_ids, **{field_name: False}).update(**{field_name: True})
+        bump_catalog_version(departament_id)
+    known_ids = set(queryset.filter(article_id__in=article_ids).values_list('article_id', flat=True))
 
-def do_import_debs(csv_file: typing.IO):
-    UserDebs.objects.all().delete()
-    reader = csv.DictReader(csv_file, fieldnames=('inn', 'document', 'date', 'amount'), delimiter=';')
-    for row in reader:
-        profile = Profile.objects.filter(inn=row['inn'].strip()).first()
-        if profile:
-            UserDebs.objects.create(
-                user_id=profile.user_id,
-                document=row['document'].strip(),
-                date_of_sale=datetime.datetime.strptime(row['date'].strip(), '%d.%m.%Y'),
-                amount=row['amount'].strip().replace(',', '.')
-            )
-
-
-def _perform_update_articles(csv_file: typing.IO, departament_id: int, field_name: str):
-    ArticleProperties.objects.filter(departament_id=departament_id).update(**{field_name: False})
-    reader = csv.reader(csv_file, delimiter=';')
+    result = {
+        'flagged': flagged,
+        'cleared': cleared,
+        'unknown': sorted(article_ids - known_ids),
+    }
+    logger.info('Import of %s for departament %s: %s', field_name, departament_id, result)
+    return result
 
-    for row in reader:
-        ArticleProperties.objects.filter(
-            departament_id=departament_id,
-            article_id=str(row[0]).strip()
-        ).update(**{field_name: True})
+
+XML_EXPORT_CHUNK_SIZE = 2000
+
+
+def _add_to_xml(xml: XMLGenerator, name: str, text: typing.Optional[str] = None, attrs: typing.Optional[dict] = None):
+    xml.startElement(name, attrs or {})
+    if text is not None:
+        xml.characters(text)
+    xml.endElement(name)
 
 
-def _add_to_xml(xml_element: ET.Element, article_property: ArticleProperties, field_name: str, subelement_name: typing.Optional[str] = None):
-    if subelement_name is None:
-        subelement_name = field_name
-    xml_subelement = ET.SubElement(xml_element, subelement_name)
-    xml_subelement.text = str(getattr(article_property, field_name))
+def export_department_to_xml(departament) -> typing.Iterator[bytes]:
+    buffer = StringIO()
+    xml = XMLGenerator(buffer, encoding='utf-8', short_empty_elements=True)
 
+    def flush() -> bytes:
+        content = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return content.encode('utf-8')
 
-def export_department_to_xml(departament) -> ET.ElementTree:
     currency_id = departament.currency
-    root = ET.Element('yml_catalog', date=now().strftime('%d.%m.%Y %H:%M'))
-    shop = ET.SubElement(root, 'shop')
-    ET.SubElement(shop, 'currencies').append(ET.Element('currency', id=currency_id, rate='1'))
-    categories = ET.SubElement(shop, 'categories')
+    xml.startDocument()
+    xml.startElement('yml_catalog', {'date': now().strftime('%d.%m.%Y %H:%M')})
+    xml.startElement('shop', {})
+    xml.startElement('currencies', {})
+    _add_to_xml(xml, 'currency', attrs={'id': currency_id, 'rate': '1'})
+    xml.endElement('currencies')
+    yield flush()
+
+    xml.startElement('categories', {})
     for category_property in CategoryProperties.objects.filter(published=True, departament=departament).only(
-            'category_id', 'name'):
-        category_xml = ET.Element('category', id=category_property.category_id)
-        category_xml.text = category_property.name
-        categories.append(category_xml)
-    offers = ET.SubElement(shop, 'offers')
-    for article_property in ArticleProperties.objects.filter(published=True,
-                                                             departament=departament).select_related('article'):
-        offer_xml = ET.Element('offer')
-        _add_to_xml(offer_xml, article_property, 'article_id', 'id')
-        available = ET.SubElement(offer_xml, 'available')
-        available.text = 'true'
-        price = ET.SubElement(offer_xml, 'price')
-        price.text = '{0:.2f}'.format(article_property.retail_price).replace('.', ',')
-        currency = ET.SubElement(offer_xml, 'currencyId')
-        currency.text = currency_id
-        category = ET.SubElement(offer_xml, 'categoryId')
-        category.text = article_property.article.category_id
-        pictures = ET.SubElement(offer_xml, 'pictures')
+            'category_id', 'name').iterator(chunk_size=XML_EXPORT_CHUNK_SIZE):
+        _add_to_xml(xml, 'category', category_property.name, {'id': category_property.category_id})
+    xml.endElement('categories')
+    yield flush()
+
+    media_url = get_media_url_prefix()
+    pictures = defaultdict(list)
+    for article_id, image in ArticleImage.objects.filter(
+            article__articleproperties__departament=departament,
+            article__articleproperties__published=True,
+    ).order_by('article_id', 'pk').values_list('article_id', 'image').iterator(chunk_size=XML_EXPORT_CHUNK_SIZE):
+        pictures[article_id].append(media_url + filepath_to_uri(image))
+
+    xml.startElement('offers', {})
+    queryset = ArticleProperties.objects.filter(published=True, departament=departament).select_related('article')
+    for index, article_property in enumerate(queryset.iterator(chunk_size=XML_EXPORT_CHUNK_SIZE), start=1):
+        xml.startElement('offer', {})
+        _add_to_xml(xml, 'id', str(article_property.article_id))
+        _add_to_xml(xml, 'available', 'true')
+        _add_to_xml(xml, 'price', '{0:.2f}'.format(article_property.retail_price).replace('.', ','))
+        _add_to_xml(xml, 'currencyId', currency_id)
+        _add_to_xml(xml, 'categoryId', article_property.article.category_id)
+        xml.startElement('pictures', {})
         if article_property.main_image:
-            main_image = ET.SubElement(pictures, 'picture')
-            main_image.text = article_property.main_image.url
-        for pic in ArticleImage.objects.filter(article=article_property.article):
-            picture = ET.SubElement(pictures, 'picture')
-            picture.text = pic.image.url
-        _add_to_xml(offer_xml, article_property, 'name')
-        ET.SubElement(offer_xml, 'vendor')
-        vendor_name = ET.SubElement(offer_xml, 'vendorCode')
-        vendor_name.text = article_property.article.vendor_code
-        _add_to_xml(offer_xml, article_property, 'description')
-        _add_to_xml(offer_xml, article_property, 'barcode')
-        _add_to_xml(offer_xml, article_property, 'length')
-        _add_to_xml(offer_xml, article_property, 'width')
-        _add_to_xml(offer_xml, article_property, 'height')
-        _add_to_xml(offer_xml, article_property, 'weight')
-
-        offers.append(offer_xml)
-
-    return ET.ElementTree(root)
+            _add_to_xml(xml, 'picture', media_url + filepath_to_uri(article_property.main_image.name))
+        for picture_url in pictures.get(article_property.article_id, ()):
+            _add_to_xml(xml, 'picture', picture_url)
+        xml.endElement('pictures')
+        _add_to_xml(xml, 'name', str(article_property.name))
+        _add_to_xml(xml, 'vendor')
+        _add_to_xml(xml, 'vendorCode', article_property.article.vendor_code)
+        _add_to_xml(xml, 'description', str(article_property.description))
+        _add_to_xml(xml, 'barcode', str(article_property.barcode))
+        _add_to_xml(xml, 'length', str(article_property.length))
+        _add_to_xml(xml, 'width', str(article_property.width))
+        _add_to_xml(xml, 'height', str(article_property.height))
+        _add_to_xml(xml, 'weight', str(article_property.weight))
+        xml.endElement('offer')
+        if index % XML_EXPORT_CHUNK_SIZE == 0:
+            yield flush()
+    xml.endElement('offers')
+
+    xml.endElement('shop')
+    xml.endElement('yml_catalog')
+    xml.endDocument()
+    yield flush()
+
+
+def read_xml_feed(feed: XMLFeed, decompress: bool) -> typing.Iterator[bytes]:
+    with feed.file.open('rb') as feed_file:
+        stream = gzip.GzipFile(fileobj=feed_file) if decompress else feed_file
+        yield from iter(lambda: stream.read(File.DEFAULT_CHUNK_SIZE), b'')
@@ -0,0 +1,42 @@
+from django.apps import apps
+from django.core.management import BaseCommand
+
+from commercial.tasks import generate_thumbnails
+
+THUMBNAIL_MODELS = [
+    "commercial.ArticleProperties",
+    "commercial.ArticleImage",
+    "commercial.Complaint",
+]
+
+
+class Command(BaseCommand):
+    help = "Generate thumbnails of article images and complaint receipts stored before they were generated on save"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sync', action='store_true', help="render in this process instead of queueing tasks")
+
+    def handle(self, *args, **options):
+        for model_label in THUMBNAIL_MODELS:
+            model = apps.get_model(model_label)
+            for field_name, sizes in model.thumbnail_fields.items():
+                url_sizes = model.thumbnail_url_fields.get(field_name, ())
+                pks = (
+                    model.objects
+                    .exclude(**{f'{field_name}__isnull': True})
+                    .exclude(**{field_name: ''})
+                    .order_by('pk')
+                    .values_list('pk', flat=True)
+                )
+                count = 0
+                for pk in pks.iterator():
+                    if not options['sync']:
+                        generate_thumbnails.delay(model_label, pk, field_name, sizes, url_sizes)
+                    else:
+                        try:
+                            generate_thumbnails(model_label, pk, field_name, sizes, url_sizes)
+                        except Exception as e:
+                            self.stderr.write(f'{model_label} {pk}: {e}')
+                            continue
+                    count += 1
+                self.stdout.write(f'{model_label}.{field_name}: {count}')
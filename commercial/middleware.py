@@ -1,23 +1,40 @@
-from django.core.exceptions import MultipleObjectsReturned
+import typing
+
+from django.utils.functional import SimpleLazyObject
 
 from commercial.models import Order
 
 
+def get_open_order(request) -> typing.Optional[Order]:
+    # A stale or foreign order id from the session falls back to the user lookup.
+    if not request.user.is_authenticated:
+        return None
+    orders = Order.objects.filter(user=request.user, is_closed=False)
+    order_id = request.session.get("order_id")
+    order = orders.filter(pk=order_id).first() if order_id else None
+    if order is None:
+        order = orders.first()
+        if order is not None:
+            request.session["order_id"] = order.pk
+        elif order_id:
+            del request.session["order_id"]
+    return order
+
+
+def get_or_create_open_order(request) -> Order:
+    order = request.order
+    if not order:
+        order, created = Order.objects.get_or_create(user=request.user, is_closed=False)
+        request.session["order_id"] = order.pk
+        request.order = order
+    return order
+
+
 class OrderMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
 
     def __call__(self, request):
-        order = None
-        if request.user.is_authenticated:
-            try:
-                order, created = Order.objects.get_or_create(
-                    user=request.user,
-                    is_closed=False
-                )
-            except MultipleObjectsReturned:
-                Order.objects.filter(user=request.user, is_closed=False).first().delete()
-                order = Order.objects.filter(user=request.user, is_closed=False).first()
-
-        request.order = order
+        # resolved on first access, requests that never read the order make no order queries
+        request.order = SimpleLazyObject(lambda: get_open_order(request))
         return self.get_response(request)
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-17 00:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('commercial', '0067_departament_currency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importnew',
+            name='result',
+            field=models.JSONField(blank=True, editable=False, null=True, verbose_name='result'),
+        ),
+        migrations.AddField(
+            model_name='importprice',
+            name='result',
+            field=models.JSONField(blank=True, editable=False, null=True, verbose_name='result'),
+        ),
+        migrations.AddField(
+            model_name='importspecial',
+            name='result',
+            field=models.JSONField(blank=True, editable=False, null=True, verbose_name='result'),
+        ),
+    ]
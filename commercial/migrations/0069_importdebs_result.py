@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 00:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('commercial', '0068_import_result'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importdebs',
+            name='result',
+            field=models.JSONField(blank=True, editable=False, null=True, verbose_name='result'),
+        ),
+    ]
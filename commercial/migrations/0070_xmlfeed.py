@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-17 00:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('commercial', '0069_importdebs_result'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XMLFeed',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(upload_to='feeds/', verbose_name='file')),
+                ('etag', models.CharField(max_length=64, verbose_name='etag')),
+                ('generated_at', models.DateTimeField(verbose_name='generated at')),
+                ('departament', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='xml_feed', to='commercial.departament', verbose_name='departament')),
+            ],
+            options={
+                'verbose_name': 'xml feed',
+                'verbose_name_plural': 'xml feeds',
+            },
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 3.2.25 on 2026-10-17 01:04
+
+from django.db import migrations, models
+
+# frozen copy of commercial.models.ORDER_TOTALS_SQL for all orders at once,
+# migrations must not follow later changes of the model code
+BACKFILL_ORDER_TOTALS_SQL = """
+    UPDATE commercial_order o SET
+        total_count = items.count,
+        total_full_sum = items.full_sum,
+        total_sum = items.sum - items.sum * COALESCE(tier.sale, 0) / 100,
+        total_volume = items.volume,
+        total_weight = items.weight,
+        applied_sale = COALESCE(tier.sale, 0)
+    FROM (
+        SELECT order_id, SUM(count) AS count, SUM(full_price * count) AS full_sum, SUM(price * count) AS sum,
+               SUM(volume * count) AS volume, SUM(weight * count) AS weight
+        FROM commercial_orderitem
+        GROUP BY order_id
+    ) items
+    JOIN commercial_order current ON current.id = items.order_id
+    LEFT JOIN commercial_profile profile ON profile.user_id = current.user_id
+    LEFT JOIN LATERAL (
+        SELECT sale FROM commercial_departamentsale
+        WHERE departament_id = profile.departament_id AND order_sum <= items.sum
+        ORDER BY order_sum DESC
+        LIMIT 1
+    ) tier ON COALESCE(profile.sale, 0) = 0
+    WHERE o.id = current.id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('commercial', '0070_xmlfeed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='applied_sale',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=5, verbose_name='applied sale in %'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_count',
+            field=models.PositiveBigIntegerField(default=0, editable=False, verbose_name='count'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_full_sum',
+            field=models.DecimalField(decimal_places=3, default=0, editable=False, max_digits=24, verbose_name='full sum'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_sum',
+            field=models.DecimalField(decimal_places=3, default=0, editable=False, max_digits=24, verbose_name='sum'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_volume',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=24, verbose_name='volume'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_weight',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=24, verbose_name='weight'),
+        ),
+        migrations.RunSQL(BACKFILL_ORDER_TOTALS_SQL, reverse_sql=migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-17 01:07
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations, models
+
+
+def fill_search_vectors(apps, schema_editor):
+    Article = apps.get_model('commercial', 'Article')
+    ArticleProperties = apps.get_model('commercial', 'ArticleProperties')
+    vendor_code = models.Subquery(Article.objects.filter(pk=models.OuterRef('article_id')).values('vendor_code')[:1])
+    search_vector = (
+        SearchVector('name', weight='A', config='simple')
+        + SearchVector('barcode', vendor_code, weight='B', config='simple')
+        + SearchVector('description', weight='D', config='simple')
+    )
+    ArticleProperties.objects.update(search_vector=search_vector)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('commercial', '0071_order_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='articleproperties',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='departament',
+            name='search_config',
+            field=models.CharField(choices=[('simple', 'simple'), ('danish', 'danish'), ('dutch', 'dutch'), ('english', 'english'), ('finnish', 'finnish'), ('french', 'french'), ('german', 'german'), ('hungarian', 'hungarian'), ('italian', 'italian'), ('lithuanian', 'lithuanian'), ('norwegian', 'norwegian'), ('portuguese', 'portuguese'), ('romanian', 'romanian'), ('russian', 'russian'), ('spanish', 'spanish'), ('swedish', 'swedish'), ('turkish', 'turkish')], default='simple', help_text='Stemming language of product search, simple only lowercases words', max_length=63, verbose_name='search language'),
+        ),
+        migrations.AddIndex(
+            model_name='articleproperties',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='search_vector_idx'),
+        ),
+        migrations.RunPython(fill_search_vectors, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-17 01:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('commercial', '0072_article_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='articleproperties',
+            index=models.Index(fields=['departament', 'barcode'], name='departament_barcode'),
+        ),
+    ]
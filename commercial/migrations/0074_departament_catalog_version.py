@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 01:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('commercial', '0073_articleproperties_barcode_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='departament',
+            name='catalog_version',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -5,13 +5,15 @@ from decimal import Decimal
 from ckeditor_uploader.fields import RichTextUploadingField
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.contrib.postgres.indexes import GistIndex
+from django.contrib.postgres.indexes import GinIndex, GistIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import (
     MinValueValidator,
     MaxValueValidator,
     FileExtensionValidator,
 )
-from django.db import models
+from django.db import connection, models
+from django.db.models.functions import Cast
 from django.urls import reverse
 from django.utils import formats
 from django.utils.translation import gettext_lazy as _
@@ -22,10 +24,68 @@ from sorl.thumbnail import ImageField
 logger = logging.getLogger(__name__)
 
 
+class ThumbnailMixin:
+    # THUMBNAIL_SIZE names each image field is rendered in by the templates
+    thumbnail_fields: typing.Dict[str, typing.Tuple[str, ...]] = {}
+    # sizes rendered from the image url copied into order items, which is a thumbnail source of its own
+    thumbnail_url_fields: typing.Dict[str, typing.Tuple[str, ...]] = {}
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._stored_images = {
+            name: getattr(instance, name).name for name in cls.thumbnail_fields if name in instance.__dict__
+        }
+        return instance
+
+    def save(self, *args, **kwargs):
+        from commercial.tasks import generate_thumbnails
+
+        stored_images = getattr(self, "_stored_images", {})
+        changed = [
+            name for name in self.thumbnail_fields
+            if name in self.__dict__ and getattr(self, name) and getattr(self, name).name != stored_images.get(name)
+        ]
+        super().save(*args, **kwargs)
+        for name in changed:
+            generate_thumbnails.delay_on_commit(
+                self._meta.label, self.pk, name, self.thumbnail_fields[name], self.thumbnail_url_fields.get(name, ())
+            )
+        self._stored_images = {**stored_images, **{name: getattr(self, name).name for name in changed}}
+
+
 class Departament(models.Model):
+    class SearchConfig(models.TextChoices):
+        SIMPLE = "simple", _("simple")
+        DANISH = "danish", _("danish")
+        DUTCH = "dutch", _("dutch")
+        ENGLISH = "english", _("english")
+        FINNISH = "finnish", _("finnish")
+        FRENCH = "french", _("french")
+        GERMAN = "german", _("german")
+        HUNGARIAN = "hungarian", _("hungarian")
+        ITALIAN = "italian", _("italian")
+        LITHUANIAN = "lithuanian", _("lithuanian")
+        NORWEGIAN = "norwegian", _("norwegian")
+        PORTUGUESE = "portuguese", _("portuguese")
+        ROMANIAN = "romanian", _("romanian")
+        RUSSIAN = "russian", _("russian")
+        SPANISH = "spanish", _("spanish")
+        SWEDISH = "swedish", _("swedish")
+        TURKISH = "turkish", _("turkish")
+
     country = CountryField(_("country"))
     email = models.EmailField(_("email"))
     currency = models.CharField(_("currency"), max_length=3, default="EUR")
+    search_config = models.CharField(
+        _("search language"),
+        max_length=63,
+        choices=SearchConfig.choices,
+        default=SearchConfig.SIMPLE,
+        help_text=_("Stemming language of product search, simple only lowercases words"),
+    )
+    # bumped together with catalog changes, cache keys of catalog data include it
+    catalog_version = models.PositiveBigIntegerField(default=0, editable=False)
 
     def __str__(self):
         return str(self.country)
@@ -192,7 +252,26 @@ class Article(models.Model):
         indexes = [models.Index(fields=["vendor_code"], name="vendor_code")]
 
 
-class ArticleProperties(models.Model):
+class ArticlePropertiesQuerySet(models.QuerySet):
+    def with_user_price(self, user):
+        sale = user.profile.sale
+        if not sale:
+            return self.annotate(user_price=models.F("price"))
+        return self.annotate(
+            user_price=Cast(
+                models.F("price") * (100 - models.Value(sale)) / 100,
+                models.DecimalField(max_digits=10, decimal_places=3),
+            )
+        )
+
+
+class ArticlePropertiesManager(models.Manager.from_queryset(ArticlePropertiesQuerySet)):
+    def get_queryset(self):
+        # the search vector is only read by the database, keep it out of the loaded rows
+        return super().get_queryset().defer("search_vector")
+
+
+class ArticleProperties(ThumbnailMixin, models.Model):
     departament = models.ForeignKey(Departament, on_delete=models.CASCADE)
     article = models.ForeignKey(Article, on_delete=models.CASCADE)
     name = models.CharField(_("name"), max_length=255)
@@ -236,6 +315,11 @@ class ArticleProperties(models.Model):
 
     company = models.CharField(_("company"), max_length=255, null=True, blank=True)
     order = models.PositiveSmallIntegerField(_("article order"), default=1000)
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = ArticlePropertiesManager()
+    thumbnail_fields = {"main_image": ("small",)}
+    thumbnail_url_fields = {"main_image": ("cart_small",)}
 
     @property
     def is_less_then_five(self):
@@ -243,12 +327,6 @@ class ArticleProperties(models.Model):
             return self.presence.lower() == "1"
         return False
 
-    def get_price_for_user(self, user):
-        price = self.price
-        if user.profile.sale:
-            price -= price * user.profile.sale / 100
-        return price
-
     class Meta:
         verbose_name = _("article property")
         verbose_name_plural = _("article properties")
@@ -260,10 +338,14 @@ class ArticleProperties(models.Model):
                 name="gist_trgm_idx", fields=["name"], opclasses=["gist_trgm_ops"]
             ),
         ]
+        indexes = [
+            GinIndex(fields=["search_vector"], name="search_vector_idx"),
+            models.Index(fields=["departament", "barcode"], name="departament_barcode"),
+        ]
         ordering = ["order", "name"]
 
 
-class ArticleImage(models.Model):
+class ArticleImage(ThumbnailMixin, models.Model):
     article = models.ForeignKey(
         Article,
         verbose_name=_("article"),
@@ -272,6 +354,8 @@ class ArticleImage(models.Model):
     )
     image = ImageField(_("image"), upload_to="photos/%Y/%m/%d/%H/%m/")
 
+    thumbnail_fields = {"image": ("small",)}
+
     def __str__(self):
         return str(self.image)
 
@@ -280,6 +364,34 @@ class ArticleImage(models.Model):
         verbose_name_plural = _("images")
 
 
+ORDER_TOTALS_SQL = """
+    UPDATE {order} o SET
+        total_count = COALESCE(items.count, 0),
+        total_full_sum = COALESCE(items.full_sum, 0),
+        total_sum = COALESCE(items.sum, 0) - COALESCE(items.sum, 0) * COALESCE(tier.sale, 0) / 100,
+        total_volume = COALESCE(items.volume, 0),
+        total_weight = COALESCE(items.weight, 0),
+        applied_sale = COALESCE(tier.sale, 0)
+    FROM {order} current
+    LEFT JOIN {profile} profile ON profile.user_id = current.user_id
+    LEFT JOIN (
+        SELECT order_id, SUM(count) AS count, SUM(full_price * count) AS full_sum, SUM(price * count) AS sum,
+               SUM(volume * count) AS volume, SUM(weight * count) AS weight
+        FROM {order_item}
+        WHERE order_id = ANY(%(order_ids)s)
+        GROUP BY order_id
+    ) items ON items.order_id = current.id
+    LEFT JOIN LATERAL (
+        SELECT sale FROM {departament_sale}
+        WHERE departament_id = profile.departament_id AND order_sum <= COALESCE(items.sum, 0)
+        ORDER BY order_sum DESC
+        LIMIT 1
+    ) tier ON COALESCE(profile.sale, 0) = 0
+    WHERE o.id = current.id AND o.id = ANY(%(order_ids)s)
+    RETURNING o.id, o.total_count, o.total_full_sum, o.total_sum, o.total_volume, o.total_weight, o.applied_sale
+"""
+
+
 class Order(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, verbose_name=_("user"), on_delete=models.CASCADE
@@ -291,40 +403,90 @@ class Order(models.Model):
     comment = models.TextField(default="", blank=True)
     is_closed = models.BooleanField(_("closed"), default=False)
 
+    # sums of up to 2**31 - 1 pieces per line
+    total_count = models.PositiveBigIntegerField(_("count"), default=0, editable=False)
+    total_full_sum = models.DecimalField(
+        _("full sum"), max_digits=24, decimal_places=3, default=0, editable=False
+    )
+    total_sum = models.DecimalField(
+        _("sum"), max_digits=24, decimal_places=3, default=0, editable=False
+    )
+    total_volume = models.DecimalField(
+        _("volume"), max_digits=24, decimal_places=2, default=0, editable=False
+    )
+    total_weight = models.DecimalField(
+        _("weight"), max_digits=24, decimal_places=2, default=0, editable=False
+    )
+    applied_sale = models.DecimalField(
+        _("applied sale in %"), max_digits=5, decimal_places=2, default=0, editable=False
+    )
+
+    TOTAL_FIELDS = ["total_count", "total_full_sum", "total_sum", "total_volume", "total_weight", "applied_sale"]
+
     def __str__(self):
         return str(self.pk)
 
+    def save(self, *args, **kwargs):
+        # totals are written by update_totals() only, a stale instance must not overwrite them
+        if not self._state.adding and kwargs.get("update_fields") is None and not args:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.TOTAL_FIELDS
+            ]
+        super(Order, self).save(*args, **kwargs)
+
+    @classmethod
+    def update_totals_of(cls, order_ids: typing.List[int]) -> typing.Dict[int, tuple]:
+        # The departament sale tier applies to users without a personal sale, like the prices in the cart.
+        sql = ORDER_TOTALS_SQL.format(
+            order=Order._meta.db_table,
+            profile=Profile._meta.db_table,
+            order_item=OrderItem._meta.db_table,
+            departament_sale=DepartamentSale._meta.db_table,
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {"order_ids": list(order_ids)})
+            return {row[0]: row[1:] for row in cursor.fetchall()}
+
+    @classmethod
+    def update_open_totals(cls, **filters):
+        cls.update_totals_of(list(cls.objects.filter(is_closed=False, **filters).values_list("pk", flat=True)))
+
+    def update_totals(self):
+        row = self.update_totals_of([self.pk]).get(self.pk)
+        if row:
+            for name, value in zip(self.TOTAL_FIELDS, row):
+                setattr(self, name, value)
+        self._items = None
+
     def get_order_items(self) -> typing.List["OrderItem"]:
         if getattr(self, "_items", None) is None:
-            self._items = list(self.items.all())
+            self._items = list(self.items.all()) if self.pk else []
         return self._items
 
     def get_order_article_ids(self):
         return list(i.article_id for i in self.get_order_items())
 
+    def get_order_item_counts(self) -> typing.Dict[str, int]:
+        return {i.article_id: i.count for i in self.get_order_items()}
+
     def full_count(self) -> int:
-        return sum(i.count for i in self.get_order_items())
+        return self.total_count
 
-    def full_sum(self):
-        return sum(i.full_price * i.count for i in self.get_order_items())
+    def full_sum(self) -> Decimal:
+        return self.total_full_sum
 
     def sum(self) -> Decimal:
-        order_sum = sum(i.price * i.count for i in self.get_order_items())
-        if not self.user.profile.sale:
-            sale = DepartamentSale.get_sale_for_departament(
-                self.user.profile.departament, order_sum
-            )
-            order_sum -= order_sum * sale / 100 if sale else 0
-        return order_sum
+        return self.total_sum
 
     sum.short_description = _("Sum")
 
     def discount(self):
-        if self.full_sum():
-            discount_sum = self.full_sum() - self.sum()
+        if self.total_full_sum:
+            discount_sum = self.total_full_sum - self.total_sum
             return {
                 "sum": discount_sum,
-                "percent": discount_sum * 100 / self.full_sum(),
+                "percent": discount_sum * 100 / self.total_full_sum,
             }
         return {"sum": 0, "percent": 0}
 
@@ -341,11 +503,11 @@ class Order(models.Model):
             }
         return {"delivery_price": 0, "total_sum": self.sum()}
 
-    def volume(self):
-        return sum(i.volume * i.count for i in self.get_order_items())
+    def volume(self) -> Decimal:
+        return self.total_volume
 
-    def weight(self):
-        return sum(i.weight * i.count for i in self.get_order_items())
+    def weight(self) -> Decimal:
+        return self.total_weight
 
     def get_absolute_url(self):
         return reverse("commercial_order_detail", kwargs={"pk": self.pk})
@@ -478,6 +640,7 @@ class ImportPrice(models.Model):
         Departament, verbose_name=_("departament"), on_delete=models.CASCADE
     )
     imported_at = models.DateTimeField(_("imported at"), auto_now_add=True)
+    result = models.JSONField(_("result"), null=True, blank=True, editable=False)
 
     def __str__(self):
         return f'ImportPrice by {self.user} at {self.imported_at.strftime("%Y-%m-%d %H:%M:%S")}'
@@ -505,6 +668,7 @@ class ImportNew(models.Model):
         Departament, verbose_name=_("departament"), on_delete=models.CASCADE
     )
     imported_at = models.DateTimeField(_("imported at"), auto_now_add=True)
+    result = models.JSONField(_("result"), null=True, blank=True, editable=False)
 
     def __str__(self):
         return f'ImportNew by {self.user} at {self.imported_at.strftime("%Y-%m-%d %H:%M:%S")}'
@@ -532,6 +696,7 @@ class ImportSpecial(models.Model):
         Departament, verbose_name=_("departament"), on_delete=models.CASCADE
     )
     imported_at = models.DateTimeField(_("imported at"), auto_now_add=True)
+    result = models.JSONField(_("result"), null=True, blank=True, editable=False)
 
     def __str__(self):
         return f'ImportSpecial by {self.user} at {self.imported_at.strftime("%Y-%m-%d %H:%M:%S")}'
@@ -556,6 +721,7 @@ class ImportDebs(models.Model):
         limit_choices_to={"is_staff": True},
     )
     imported_at = models.DateTimeField(_("imported at"), auto_now_add=True)
+    result = models.JSONField(_("result"), null=True, blank=True, editable=False)
 
     def __str__(self):
         return f'ImportSpecial by {self.user} at {self.imported_at.strftime("%Y-%m-%d %H:%M:%S")}'
@@ -571,6 +737,25 @@ class ImportDebs(models.Model):
         verbose_name_plural = _("import debts")
 
 
+class XMLFeed(models.Model):
+    departament = models.OneToOneField(
+        Departament,
+        verbose_name=_("departament"),
+        related_name="xml_feed",
+        on_delete=models.CASCADE,
+    )
+    file = models.FileField(_("file"), upload_to="feeds/")
+    etag = models.CharField(_("etag"), max_length=64)
+    generated_at = models.DateTimeField(_("generated at"))
+
+    def __str__(self):
+        return f'XMLFeed for {self.departament} at {self.generated_at.strftime("%Y-%m-%d %H:%M:%S")}'
+
+    class Meta:
+        verbose_name = _("xml feed")
+        verbose_name_plural = _("xml feeds")
+
+
 class Page(models.Model):
     ABOUT = "about"
     CONTACTS = "contacts"
@@ -595,7 +780,7 @@ class Page(models.Model):
         verbose_name_plural = _("pages")
 
 
-class Complaint(models.Model):
+class Complaint(ThumbnailMixin, models.Model):
     class ComplaintStatus(models.IntegerChoices):
         OPENED = 0, _("opened")
         CLOSED = 1, _("closed")
@@ -622,6 +807,8 @@ class Complaint(models.Model):
     )
     created_date = models.DateField(_("date of create"), auto_now_add=True)
 
+    thumbnail_fields = {"receipt": ("complaint",)}
+
     def image(self):
         msg: Message = self.message_set.first()
         if msg:
@@ -0,0 +1,145 @@
+import re
+import typing
+from array import array
+
+from django.contrib.postgres.lookups import PostgresOperatorLookup
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramBase
+from django.db import models
+from django.db.models.lookups import IContains
+
+from commercial.models import Article, ArticleProperties, Departament
+
+# barcodes and vendor codes are indexed and searched without stemming
+CODES_SEARCH_CONFIG = Departament.SearchConfig.SIMPLE
+AUTOCOMPLETE_LIMIT = 20
+# shorter terms have no trigram to look up in the index
+AUTOCOMPLETE_INFIX_MIN_LENGTH = 3
+WORD_START_RE = re.compile(r"\b\w")
+
+
+@models.CharField.register_lookup
+class TrigramWordSimilar(PostgresOperatorLookup):
+    # Served by the trigram GiST index on the column.
+    lookup_name = "trigram_word_similar"
+    postgres_operator = "%%>"
+
+
+@models.CharField.register_lookup
+class TrigramIContains(IContains):
+    # Unlike UPPER(column) LIKE, ILIKE is served by the trigram index.
+    lookup_name = "trigram_icontains"
+
+    def as_sql(self, compiler, connection):
+        lhs_sql, lhs_params = self.process_lhs(compiler, connection)
+        rhs_sql, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs_sql} ILIKE {rhs_sql}", lhs_params + rhs_params
+
+
+class TrigramWordDistance(TrigramBase):
+
+    function = ""
+    arg_joiner = " <->> "
+
+
+def get_search_vector(config: str) -> SearchVector:
+    vendor_code = models.Subquery(Article.objects.filter(pk=models.OuterRef("article_id")).values("vendor_code")[:1])
+    return (
+        SearchVector("name", weight="A", config=config)
+        + SearchVector("barcode", vendor_code, weight="B", config=CODES_SEARCH_CONFIG)
+        + SearchVector("description", weight="D", config=config)
+    )
+
+
+def update_search_vectors(departament: Departament, article_ids: typing.Optional[typing.Iterable[str]] = None) -> int:
+    queryset = ArticleProperties.objects.filter(departament=departament)
+    if article_ids is not None:
+        queryset = queryset.filter(article_id__in=list(article_ids))
+    return queryset.update(search_vector=get_search_vector(departament.search_config))
+
+
+def search_articles(queryset: models.QuerySet, query: str, config: str = CODES_SEARCH_CONFIG) -> models.QuerySet:
+    # Similar names catch typos and queries shorter than a word.
+    search_query = SearchQuery(query, config=config, search_type="websearch") | SearchQuery(
+        query, config=CODES_SEARCH_CONFIG, search_type="websearch"
+    )
+    return (
+        queryset.filter(
+            models.Q(search_vector=search_query)
+            | models.Q(name__trigram_word_similar=query)
+            | models.Q(name__trigram_icontains=query)
+        )
+        .annotate(
+            search_rank=SearchRank(models.F("search_vector"), search_query),
+            search_distance=TrigramWordDistance("name", query),
+        )
+        .order_by(
+            models.F("search_rank").desc(nulls_last=True), "search_distance", "order", "name", "id"
+        )
+    )
+
+
+class PrefixIndex:
+    # Names with a word starting with the term are a contiguous run of the sorted word starts.
+    def __init__(self, names: typing.Iterable[str]):
+        self.names = sorted(set(names), key=lambda name: (name.casefold(), name))
+        folded_names = [name.casefold() for name in self.names]
+        entries = [
+            (position, match.start())
+            for position, folded in enumerate(folded_names)
+            for match in WORD_START_RE.finditer(folded)
+        ]
+        entries.sort(key=lambda entry: folded_names[entry[0]][entry[1]:])
+        self.positions = array("L", [position for position, offset in entries])
+        self.offsets = array("H", [offset for position, offset in entries])
+
+    def __len__(self):
+        return len(self.names)
+
+    def _prefix(self, index: int, length: int) -> str:
+        offset = self.offsets[index]
+        return self.names[self.positions[index]].casefold()[offset:offset + length]
+
+    def search(self, term: str, limit: int = AUTOCOMPLETE_LIMIT) -> typing.List[str]:
+        term = term.casefold()
+        # comparing only len(term) characters of the entry finds the same lower bound as the whole suffix
+        low, high = 0, len(self.positions)
+        while low < high:
+            middle = (low + high) // 2
+            if self._prefix(middle, len(term)) < term:
+                low = middle + 1
+            else:
+                high = middle
+        found = []
+        seen = set()
+        index = low
+        while index < len(self.positions) and len(found) < limit and self._prefix(index, len(term)) == term:
+            position = self.positions[index]
+            if position not in seen:
+                seen.add(position)
+                found.append(self.names[position])
+            index += 1
+        return found
+
+
+_prefix_indexes: typing.Dict[int, typing.Tuple[int, PrefixIndex]] = {}
+
+
+def get_prefix_index(departament: Departament) -> PrefixIndex:
+    cached = _prefix_indexes.get(departament.pk)
+    if cached is None or cached[0] != departament.catalog_version:
+        names = ArticleProperties.objects.filter(
+            departament=departament, published=True
+        ).order_by().values_list("name", flat=True).distinct()
+        cached = _prefix_indexes[departament.pk] = (departament.catalog_version, PrefixIndex(names))
+    return cached[1]
+
+
+def autocomplete_names(departament: Departament, term: str, limit: int = AUTOCOMPLETE_LIMIT) -> typing.List[str]:
+    if not term:
+        return []
+    names = get_prefix_index(departament).search(term, limit)
+    if len(names) < limit and len(term) >= AUTOCOMPLETE_INFIX_MIN_LENGTH:
+        names += ArticleProperties.objects.filter(
+            departament=departament, published=True, name__trigram_icontains=term
+        ).exclude(name__in=names).order_by("name").values_list("name", flat=True).distinct()[: limit - len(names)]
+    return names
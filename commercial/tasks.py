@@ -1,71 +1,148 @@
+import contextlib
+import gzip
+import hashlib
 import io
+import tempfile
+import typing
 
 from django.conf import settings
+from django.core.files import File
 from django.core.mail import EmailMultiAlternatives
+from django.db import connection, transaction
 from django.template.loader import render_to_string
+from django.utils.encoding import filepath_to_uri
 from django.utils.html import strip_tags
+from django.utils.timezone import now
 
 from babytilly2.celery import app
 
+XML_FEED_LOCK_ID = 0x786D6C
+
+
+@contextlib.contextmanager
+def open_import_file(field_file) -> typing.Iterator[typing.TextIO]:
+    # S3 objects are read from the response body, so parsing starts with the first chunk.
+    storage_file = field_file.storage.open(field_file.name, mode="rb")
+    s3_object = getattr(storage_file, "obj", None)
+    stream = s3_object.get()["Body"] if s3_object is not None else storage_file
+    try:
+        yield io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    finally:
+        stream.close()
+        storage_file.close()
+
 
 @app.task()
-def import_price(import_id: int) -> None:
+def import_price(import_id: int) -> dict:
     from commercial.models import ImportPrice
     from commercial.functions import do_import_price
 
     import_price: ImportPrice = ImportPrice.objects.get(id=import_id)
 
-    in_memory_file = io.StringIO()
-    with import_price.file.open(mode="rb") as import_file:
-        in_memory_file.writelines([l.decode("utf-8-sig") for l in import_file.readlines()])
-        in_memory_file.seek(0)
-
-    do_import_price(csv_file=in_memory_file, country=import_price.departament.country)
+    with open_import_file(import_price.file) as csv_file:
+        result = do_import_price(csv_file=csv_file, country=import_price.departament.country)
+    ImportPrice.objects.filter(id=import_id).update(result=result)
+    build_xml_feed.delay(import_price.departament_id)
+    return result
 
 
 @app.task()
-def import_novelty(import_id: int) -> None:
+def import_novelty(import_id: int) -> dict:
     from commercial.models import ImportNew
     from commercial.functions import do_import_novelty
 
     import_price: ImportNew = ImportNew.objects.get(id=import_id)
 
-    in_memory_file = io.StringIO()
-    with import_price.file.open(mode="rb") as import_file:
-        in_memory_file.writelines([l.decode("utf-8-sig") for l in import_file.readlines()])
-        in_memory_file.seek(0)
-
-    do_import_novelty(csv_file=in_memory_file, departament_id=import_price.departament_id)
+    with open_import_file(import_price.file) as csv_file:
+        result = do_import_novelty(csv_file=csv_file, departament_id=import_price.departament_id)
+    ImportNew.objects.filter(id=import_id).update(result=result)
+    build_xml_feed.delay(import_price.departament_id)
+    return result
 
 
 @app.task()
-def import_special(import_id: int):
+def import_special(import_id: int) -> dict:
     from commercial.models import ImportSpecial
     from commercial.functions import do_import_special
 
     import_special = ImportSpecial.objects.get(id=import_id)
 
-    in_memory_file = io.StringIO()
-    with import_special.file.open(mode="rb") as import_file:
-        in_memory_file.writelines([l.decode("utf-8-sig") for l in import_file.readlines()])
-        in_memory_file.seek(0)
-
-    do_import_special(csv_file=in_memory_file, departament_id=import_special.departament_id)
+    with open_import_file(import_special.file) as csv_file:
+        result = do_import_special(csv_file=csv_file, departament_id=import_special.departament_id)
+    ImportSpecial.objects.filter(id=import_id).update(result=result)
+    build_xml_feed.delay(import_special.departament_id)
+    return result
 
 
 @app.task()
-def import_debs(import_id: int):
+def import_debs(import_id: int) -> dict:
     from commercial.models import ImportDebs
     from commercial.functions import do_import_debs
 
     import_debs = ImportDebs.objects.get(id=import_id)
 
-    in_memory_file = io.StringIO()
-    with import_debs.file.open(mode="rb") as import_file:
-        in_memory_file.writelines([l.decode("utf-8-sig") for l in import_file.readlines()])
-        in_memory_file.seek(0)
+    with open_import_file(import_debs.file) as csv_file:
+        result = do_import_debs(csv_file=csv_file)
+    ImportDebs.objects.filter(id=import_id).update(result=result)
+    return result
 
-    do_import_debs(csv_file=in_memory_file)
+
+@app.task()
+def generate_thumbnails(
+    model_label: str, pk: int, field_name: str, sizes: typing.Sequence[str], url_sizes: typing.Sequence[str] = ()
+) -> int:
+    from django.apps import apps
+    from sorl.thumbnail import get_thumbnail
+    from commercial.functions import get_media_url_prefix
+
+    instance = apps.get_model(model_label).objects.filter(pk=pk).first()
+    image = getattr(instance, field_name, None)
+    if not image:
+        return 0
+    for size in sizes:
+        get_thumbnail(image, settings.THUMBNAIL_SIZE[size], crop="center")
+    # same source string as the main_image_url that order items get from get_main_image_urls
+    url = get_media_url_prefix() + filepath_to_uri(image.name)
+    for size in url_sizes:
+        get_thumbnail(url, settings.THUMBNAIL_SIZE[size], crop="center")
+    return len(sizes) + len(url_sizes)
+
+
+@app.task()
+def build_xml_feed(departament_id: int) -> str:
+    # The stored feed is replaced only when the catalog content changed.
+    from commercial.models import Departament, XMLFeed
+    from commercial.functions import export_department_to_xml
+
+    with transaction.atomic():
+        # concurrent builds of one departament would race on inserting its feed
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [XML_FEED_LOCK_ID, departament_id])
+        departament = Departament.objects.get(id=departament_id)
+        feed = XMLFeed.objects.filter(departament=departament).first() or XMLFeed(departament=departament)
+        content_hash = hashlib.sha256(departament.currency.encode())
+        with tempfile.TemporaryFile() as feed_file:
+            with gzip.GzipFile(fileobj=feed_file, mode="wb", mtime=0) as gzip_file:
+                chunks = export_department_to_xml(departament)
+                # the header chunk differs only by generation date, keep it out of the hash
+                gzip_file.write(next(chunks))
+                for chunk in chunks:
+                    content_hash.update(chunk)
+                    gzip_file.write(chunk)
+            etag = content_hash.hexdigest()
+            if feed.pk and feed.etag == etag:
+                return etag
+
+            old_file_name = feed.file.name
+            feed_file.seek(0)
+            file_name = f"{departament.country.code.lower()}_offer.{etag[:16]}.xml.gz"
+            feed.file.save(file_name, File(feed_file), save=False)
+            feed.etag = etag
+            feed.generated_at = now()
+            feed.save()
+    if old_file_name and old_file_name != feed.file.name:
+        feed.file.storage.delete(old_file_name)
+    return etag
 
 
 @app.task()
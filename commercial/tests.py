@@ -1,3 +1,66 @@
-from django.test import TestCase
+from django.template import Context, Template
+from django.test import SimpleTestCase, TestCase
 
-# Create your tests here.
+from commercial.models import Category, CategoryProperties, Departament
+from commercial.search import PrefixIndex
+
+
+class RecurseTreeTest(TestCase):
+    template = Template(
+        "{% load commercial_tags %}"
+        "{% recursetree nodes %}[{{ node.name }}{{ children }}]{% endrecursetree %}"
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.departament = Departament.objects.create(country="DE", email="de@example.com")
+
+    def create_tree(self, width, depth, parent=None, prefix=""):
+        for index in range(width):
+            name = f"{prefix}{index}"
+            category = Category.objects.create(id=f"c{name}", parent=parent)
+            CategoryProperties.objects.create(category=category, departament=self.departament, name=name)
+            if depth > 1:
+                self.create_tree(width, depth - 1, category, f"{name}.")
+
+    def render(self):
+        nodes = CategoryProperties.objects.filter(
+            departament=self.departament
+        ).select_related("category").order_by("name")
+        return self.template.render(Context({"nodes": nodes}))
+
+    def test_renders_nested_children(self):
+        self.create_tree(2, 2)
+        self.assertEqual(self.render(), "[0[0.0][0.1]][1[1.0][1.1]]")
+
+    def test_query_count_does_not_depend_on_tree_size(self):
+        self.create_tree(2, 1)
+        with self.assertNumQueries(1):
+            self.render()
+
+        self.create_tree(3, 3, prefix="x")
+        with self.assertNumQueries(1):
+            self.render()
+
+    def test_skips_unpublished_branches(self):
+        self.create_tree(2, 2)
+        CategoryProperties.objects.filter(name="1").update(published=False)
+        nodes = CategoryProperties.objects.filter(
+            departament=self.departament, published=True
+        ).select_related("category").order_by("name")
+        self.assertEqual(self.template.render(Context({"nodes": nodes})), "[0[0.0][0.1]]")
+
+
+class PrefixIndexTest(SimpleTestCase):
+    index = PrefixIndex(["Brake disc", "brake pad", "Disc brake set", "Oil filter", "Oil filter", "Air-filter"])
+
+    def test_matches_word_prefixes_ignoring_case(self):
+        self.assertEqual(self.index.search("BRAKE"), ["Brake disc", "brake pad", "Disc brake set"])
+        self.assertEqual(self.index.search("filt"), ["Air-filter", "Oil filter"])
+
+    def test_skips_infix_matches(self):
+        self.assertEqual(self.index.search("rake"), [])
+
+    def test_limits_results(self):
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.index.search("b", limit=2), ["Brake disc", "brake pad"])
@@ -21,6 +21,8 @@ from django.views.generic import TemplateView
 from commercial.views import (
     ArticleListView,
     AddToCartView,
+    AddLinesToCartView,
+    CartView,
     OrderListView,
     OrderDetailView,
     ArticleNewListView,
@@ -32,17 +34,19 @@ from commercial.views import (
     ComplaintCreateView,
     ComplaintDetailView,
     ArticleNameAutocompleteView,
+    ArticleLookupView,
     LatestComplaintsJSONView,
 )
 
 urlpatterns = [
     path("cart/", EditCartView.as_view(), name="commercial_edit_cart"),
-    path("showcart/", AddToCartView.as_view(), name="commercial_show_cart"),
+    path("showcart/", CartView.as_view(), name="commercial_show_cart"),
     path(
         "getimages/<str:id>/",
         DownloadArticleImages.as_view(),
         name="commercial_download_images_url",
     ),
+    path("addtocart/", AddLinesToCartView.as_view(), name="commercial_addto_cart_lines"),
     path(
         "addtocart/<str:id>/", AddToCartView.as_view(), name="commercial_addto_cart_one"
     ),
@@ -79,6 +83,7 @@ urlpatterns = [
         ArticleNameAutocompleteView.as_view(),
         name="article_autocomplete_url",
     ),
+    path("lookup/", ArticleLookupView.as_view(), name="article_lookup_url"),
     path("new/", ArticleNewListView.as_view(), name="new_list_url"),
     path("sale/", ArticleSaleListView.as_view(), name="sale_list_url"),
     path("<str:country>_offer.xml", ExportToXML.as_view()),
@@ -1,16 +1,21 @@
+import hashlib
 import io
+import json
 import logging
-import sys
 import zipfile
+from functools import partial
 from urllib.parse import urlencode
 
 from django.conf import settings
 from django.contrib.auth import logout
 from django.contrib.auth.mixins import UserPassesTestMixin
+from django.core.cache import cache
 from django.forms import modelformset_factory
-from django.http import HttpResponseRedirect, FileResponse, HttpResponse, JsonResponse
+from django.http import Http404, HttpResponseRedirect, FileResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
 from django.utils.translation import gettext_lazy
 from django.views import View
 from django.views.generic import (
@@ -22,11 +27,23 @@ from django.views.generic import (
 )
 from django.views.generic.base import TemplateResponseMixin
 
+from commercial.catalog import CachedCountPaginator, KeysetPaginator, InvalidCursor, get_catalog_count
 from commercial.forms import EditOrderForm, OrderItemForm, MessageForm, ComplaintForm
-from commercial.functions import export_department_to_xml
+from commercial.functions import (
+    export_department_to_xml,
+    read_xml_feed,
+    add_to_order,
+    add_lines_to_order,
+    lookup_article_codes,
+    MAX_ORDER_COUNT,
+    parse_order_lines,
+    parse_order_items,
+)
+from commercial.middleware import get_or_create_open_order
 from commercial.models import (
     StartPageImage,
     Category,
+    CategoryProperties,
     ArticleProperties,
     Order,
     OrderItem,
@@ -38,7 +55,8 @@ from commercial.models import (
     Message,
     MessageAttachment,
 )
-from commercial.tasks import send_order_email, send_complaint_mail
+from commercial.search import autocomplete_names, search_articles
+from commercial.tasks import send_order_email, send_complaint_mail, build_xml_feed
 
 logger = logging.getLogger(__name__)
 
@@ -81,168 +99,181 @@ class PageDetailView(ActiveRequiredMixin, DetailView):
         return queryset
 
 
-class ArticleListView(ActiveRequiredMixin, ListView):
+class ArticlePropertiesListView(ActiveRequiredMixin, ListView):
     template_name = "commercial/articleprice_list.html"
     context_object_name = "object_list"
+    paginator_class = CachedCountPaginator
+    keyset_pagination = settings.CATALOG_KEYSET_PAGINATION
 
     def get_paginate_by(self, queryset):
         return int(self.request.GET.get("per_page", settings.PAGINATOR[2]))
 
+    def get_articles(self, departament):
+        return ArticleProperties.objects.none()
+
+    def get_count_key(self):
+        return None
+
+    def get_count(self, queryset):
+        key = self.get_count_key()
+        if key is None:
+            return None
+        return get_catalog_count(self.request.user.profile.departament, key, queryset)
+
+    def get_keyset_ordering(self):
+        sort = self.request.GET.get("sort", None)
+        if sort == "price":
+            return ["price", "id"]
+        if sort == "-price":
+            return ["-price", "-id"]
+        return ["order", "name", "id"]
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        return self.paginator_class(
+            queryset,
+            per_page,
+            count=self.get_count(queryset),
+            orphans=orphans,
+            allow_empty_first_page=allow_empty_first_page,
+            **kwargs,
+        )
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.keyset_pagination:
+            return super(ArticlePropertiesListView, self).paginate_queryset(queryset, page_size)
+        paginator = KeysetPaginator(queryset, page_size, self.get_keyset_ordering(), count=self.get_count(queryset))
+        try:
+            page = paginator.page(self.request.GET.get("cursor"))
+        except InvalidCursor:
+            raise Http404(gettext_lazy("Invalid cursor"))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_page_title(self):
+        return ""
+
     def get_queryset(self):
         sort = self.request.GET.get("sort", None)
-        user_departament_id = self.request.user.profile.departament_id
-        queryset = ArticleProperties.objects.filter(
-            published=True,
-            departament_id=user_departament_id,
-            article__category__id=self.kwargs["id"],
-        ).select_related("article")
+        queryset = (
+            self.get_articles(self.request.user.profile.departament)
+            .with_user_price(self.request.user)
+            .select_related("article")
+            .prefetch_related("article__images")
+        )
 
         if sort == "price":
-            queryset = queryset.order_by("price")
+            queryset = queryset.order_by("user_price")
         if sort == "-price":
-            queryset = queryset.order_by("-price")
+            queryset = queryset.order_by("-user_price")
 
         return queryset
 
     def get_context_data(self, **kwargs):
-        context = super(ArticleListView, self).get_context_data(**kwargs)
+        context = super(ArticlePropertiesListView, self).get_context_data(**kwargs)
+        order = getattr(self.request, "order", None)
+        cart = order.get_order_item_counts() if order else {}
+        for item in context["object_list"]:
+            item.cart_count = cart.get(item.article_id)
         params = self.request.GET.copy()
-        if "page" in params:
-            del params["page"]
-        category = get_object_or_404(Category, id=self.kwargs["id"])
-        property = category.categoryproperties_set.filter(
-            departament_id=self.request.user.profile.departament_id
-        ).first()
-        page_title = property.name if property else ""
+        for name in ("page", "cursor"):
+            if name in params:
+                del params[name]
         context.update(
             {
-                "category": category,
+                "keyset_pagination": self.keyset_pagination,
+                "page_title": self.get_page_title(),
                 "sort": self.request.GET.get("sort", None),
                 "per_page": self.get_paginate_by(None),
                 "paginator_list": settings.PAGINATOR,
                 "link": urlencode(params),
-                "page_title": page_title,
             }
         )
         return context
 
 
-class ArticleSearchListView(ActiveRequiredMixin, ListView):
-    template_name = "commercial/articleprice_list.html"
-    context_object_name = "object_list"
+class ArticleListView(ArticlePropertiesListView):
+    def get_articles(self, departament):
+        return ArticleProperties.objects.filter(
+            published=True,
+            departament=departament,
+            article__category__id=self.kwargs["id"],
+        )
 
-    def get_paginate_by(self, queryset):
-        return int(self.request.GET.get("per_page", settings.PAGINATOR[2]))
+    def get_count_key(self):
+        return f"category:{self.kwargs['id']}"
 
-    def get_queryset(self):
-        sort = self.request.GET.get("sort", None)
-        search_str = self.request.GET.get("query", "").strip()
-        user_departament_id = self.request.user.profile.departament_id
-        if search_str:
-            queryset = ArticleProperties.objects.filter(
-                published=True,
-                name__icontains=search_str,
-                departament_id=user_departament_id,
+    def get_breadcrumbs(self):
+        return list(
+            CategoryProperties.objects.filter(
+                departament_id=self.request.user.profile.departament_id,
+                category__tree_id=self.category.tree_id,
+                category__lft__lte=self.category.lft,
+                category__rght__gte=self.category.rght,
             )
-        else:
-            queryset = ArticleProperties.objects.none()
-
-        if sort == "price":
-            queryset = queryset.order_by("price")
-        if sort == "-price":
-            queryset = queryset.order_by("-price")
+            .only("name", "category_id")
+            .order_by("category__lft")
+        )
 
-        return queryset
+    def get_page_title(self):
+        if self.breadcrumbs and self.breadcrumbs[-1].category_id == self.category.id:
+            return self.breadcrumbs[-1].name
+        return ""
 
-    def get_context_data(self, *args, **kwargs):
-        context = super(ArticleSearchListView, self).get_context_data(*args, **kwargs)
-        params = self.request.GET.copy()
-        if "page" in params:
-            del params["page"]
+    def get_context_data(self, **kwargs):
+        self.category = get_object_or_404(Category, id=self.kwargs["id"])
+        self.breadcrumbs = self.get_breadcrumbs()
+        context = super(ArticleListView, self).get_context_data(**kwargs)
         context.update(
             {
-                "page_title": self.request.GET.get("query", "").strip(),
-                "sort": self.request.GET.get("sort", None),
-                "per_page": self.get_paginate_by(None),
-                "paginator_list": settings.PAGINATOR,
-                "link": urlencode(params),
+                "category": self.category,
+                "breadcrumbs": self.breadcrumbs,
+                "category_ancestor_ids": [item.category_id for item in self.breadcrumbs],
             }
         )
         return context
 
 
-class ArticleNewListView(ActiveRequiredMixin, ListView):
-    template_name = "commercial/articleprice_list.html"
-    context_object_name = "object_list"
+class ArticleSearchListView(ArticlePropertiesListView):
+    # results are ranked by relevance, which has no stable cursor
+    keyset_pagination = False
 
-    def get_paginate_by(self, queryset):
-        return int(self.request.GET.get("per_page", settings.PAGINATOR[2]))
+    def get_articles(self, departament):
+        search_str = self.request.GET.get("query", "").strip()
+        if search_str:
+            return search_articles(
+                ArticleProperties.objects.filter(published=True, departament=departament),
+                search_str,
+                config=departament.search_config,
+            )
+        return ArticleProperties.objects.none()
 
-    def get_queryset(self):
-        sort = self.request.GET.get("sort", None)
-        user_departament_id = self.request.user.profile.departament_id
-        queryset = ArticleProperties.objects.filter(
-            published=True, departament_id=user_departament_id, is_new=True
-        ).select_related("article")
+    def get_count_key(self):
+        search_str = self.request.GET.get("query", "").strip().lower()
+        return f"search:{hashlib.md5(search_str.encode()).hexdigest()}"
 
-        if sort == "price":
-            queryset = queryset.order_by("price")
-        if sort == "-price":
-            queryset = queryset.order_by("-price")
+    def get_page_title(self):
+        return self.request.GET.get("query", "").strip()
 
-        return queryset
-
-    def get_context_data(self, *args, **kwargs):
-        context = super(ArticleNewListView, self).get_context_data(*args, **kwargs)
-        params = self.request.GET.copy()
-        if "page" in params:
-            del params["page"]
-        context.update(
-            {
-                "page_title": gettext_lazy("New"),
-                "sort": self.request.GET.get("sort", None),
-                "per_page": self.get_paginate_by(None),
-                "paginator_list": settings.PAGINATOR,
-                "link": urlencode(params),
-            }
-        )
-        return context
 
+class ArticleNewListView(ArticlePropertiesListView):
+    def get_articles(self, departament):
+        return ArticleProperties.objects.filter(published=True, departament=departament, is_new=True)
 
-class ArticleSaleListView(ActiveRequiredMixin, ListView):
-    template_name = "commercial/articleprice_list.html"
-    context_object_name = "object_list"
+    def get_count_key(self):
+        return "new"
 
-    def get_paginate_by(self, queryset):
-        return int(self.request.GET.get("per_page", settings.PAGINATOR[2]))
+    def get_page_title(self):
+        return gettext_lazy("New")
 
-    def get_queryset(self):
-        sort = self.request.GET.get("sort", None)
-        user_departament_id = self.request.user.profile.departament_id
-        queryset = ArticleProperties.objects.filter(published=True, departament_id=user_departament_id, is_special=True)
 
-        if sort == "price":
-            queryset = queryset.order_by("price")
-        if sort == "-price":
-            queryset = queryset.order_by("-price")
+class ArticleSaleListView(ArticlePropertiesListView):
+    def get_articles(self, departament):
+        return ArticleProperties.objects.filter(published=True, departament=departament, is_special=True)
 
-        return queryset
+    def get_count_key(self):
+        return "sale"
 
-    def get_context_data(self, *args, **kwargs):
-        context = super(ArticleSaleListView, self).get_context_data(*args, **kwargs)
-        params = self.request.GET.copy()
-        if "page" in params:
-            del params["page"]
-        context.update(
-            {
-                "page_title": gettext_lazy("Sale"),
-                "sort": self.request.GET.get("sort", None),
-                "per_page": self.get_paginate_by(None),
-                "paginator_list": settings.PAGINATOR,
-                "link": urlencode(params),
-            }
-        )
-        return context
+    def get_page_title(self):
+        return gettext_lazy("Sale")
 
 
 class OrderListView(ActiveRequiredMixin, ListView):
@@ -347,56 +378,98 @@ class ComplaintDetailView(ActiveRequiredMixin, FormView):
         return super().form_valid(form)
 
 
-class AddToCartView(ActiveRequiredMixin, TemplateView):
+class CartView(ActiveRequiredMixin, TemplateView):
     template_name = "commercial/cart.html"
 
     def get_context_data(self, **kwargs):
-        context = super(AddToCartView, self).get_context_data(**kwargs)
-        user_departament_id = self.request.user.profile.departament_id
-        order = getattr(self.request, "order", None)
-        article_id = self.kwargs.get("id", None)
-        try:
-            count = int(self.kwargs.get("count", "1"))
-        except ValueError:
-            count = 1
-        count = max(min(count, sys.maxsize), 1)
-        logger.debug("add to cart: %s", order)
-        if article_id:
-            if not order:
-                order = Order(user=self.request.user)
-                order.save()
-                self.request.session["order_id"] = order.pk
-                self.request.order = order
-            article_property = get_object_or_404(
-                ArticleProperties,
-                article_id=article_id,
-                departament_id=user_departament_id,
-            )
-            order_item, _ = OrderItem.objects.get_or_create(order=order, article_id=article_id)
-            order_item.count = count
-            order_item.name = article_property.name
-            order_item.volume = article_property.volume
-            order_item.weight = article_property.weight
-            order_item.barcode = article_property.barcode
-            order_item.company = article_property.company
-            order_item.price = article_property.get_price_for_user(self.request.user)
-            order_item.full_price = article_property.price
-            if article_property.main_image:
-                order_item.main_image_url = article_property.main_image.url
-            order_item.save()
-        context.update({"order": self.request.order})
+        context = super(CartView, self).get_context_data(**kwargs)
+        context.update({"order": self.request.order or None})
         return context
 
 
+class AddToCartView(ActiveRequiredMixin, View):
+    def get(self, request, *args, **kwargs):
+        article_id = self.kwargs["id"]
+        count = max(min(self.kwargs.get("count", 1), MAX_ORDER_COUNT), 1)
+        result = add_to_order(partial(get_or_create_open_order, request), request.user, {article_id: count})
+        if not result["added"]:
+            raise Http404(gettext_lazy("Article not found"))
+        return JsonResponse(result)
+
+
+class AddLinesToCartView(ActiveRequiredMixin, View):
+
+    max_lines = 1000
+
+    def post(self, request, *args, **kwargs):
+        if request.content_type == "application/json":
+            try:
+                items = json.loads(request.body).get("items", [])
+            except (ValueError, AttributeError):
+                return JsonResponse({"error": gettext_lazy("Invalid JSON")}, status=400)
+            if not isinstance(items, list):
+                return JsonResponse({"error": gettext_lazy("Invalid JSON")}, status=400)
+            lines, invalid = parse_order_items(items)
+        else:
+            lines, invalid = parse_order_lines(request.POST.get("lines", ""))
+        if len(lines) > self.max_lines:
+            return JsonResponse(
+                {"error": gettext_lazy("Too many lines, at most %d are allowed") % self.max_lines}, status=400
+            )
+        result = add_lines_to_order(partial(get_or_create_open_order, request), request.user, lines)
+        result["invalid"] = invalid
+        return JsonResponse(result)
+
+
+class ArticleLookupView(ActiveRequiredMixin, View):
+
+    max_codes = 100
+
+    def get(self, request, *args, **kwargs):
+        codes = [code.strip() for code in request.GET.getlist("code")]
+        codes += [code.strip() for code in request.GET.get("codes", "").split(",")]
+        codes = list(dict.fromkeys(code for code in codes if code))
+        if len(codes) > self.max_codes:
+            return JsonResponse(
+                {"error": gettext_lazy("Too many codes, at most %d are allowed") % self.max_codes}, status=400
+            )
+        found = lookup_article_codes(request.user, codes)
+        return JsonResponse(
+            {
+                "articles": {
+                    code: {
+                        "id": item.article_id,
+                        "name": item.name,
+                        "barcode": item.barcode,
+                        "vendor_code": item.article.vendor_code,
+                        "published": item.published,
+                        "price": "%.2f" % item.user_price,
+                        "retail_price": "%.2f" % item.retail_price,
+                        "presence": item.presence,
+                    }
+                    for code, item in found.items()
+                },
+                "unknown": [code for code in codes if code not in found],
+            }
+        )
+
+
 class EditCartView(ActiveRequiredMixin, TemplateResponseMixin, View):
     template_name = "commercial/editcart.html"
 
+    def get_order_items(self, order):
+        if order.pk is None:
+            return OrderItem.objects.none()
+        return OrderItem.objects.filter(order=order)
+
     def get(self, request, *args, **kwargs):
         OrderItemFormSet = modelformset_factory(OrderItem, form=OrderItemForm, can_delete=True, extra=0)
-        order_form = EditOrderForm(instance=self.request.order)
-        order_items_formset = OrderItemFormSet(queryset=OrderItem.objects.filter(order=self.request.order))
+        # an empty cart is shown without creating the order
+        order = request.order or Order(user=request.user)
+        order_form = EditOrderForm(instance=order)
+        order_items_formset = OrderItemFormSet(queryset=self.get_order_items(order))
         context = {
-            "order": request.order,
+            "order": order,
             "form": order_form,
             "order_items_formset": order_items_formset,
             "debts": UserDebs.objects.filter(user=request.user),
@@ -405,23 +478,23 @@ class EditCartView(ActiveRequiredMixin, TemplateResponseMixin, View):
 
     def post(self, request, *args, **kwargs):
         OrderItemFormSet = modelformset_factory(OrderItem, form=OrderItemForm, can_delete=True, extra=0)
-        order_form = EditOrderForm(request.POST, instance=request.order)
-        order_items_formset = OrderItemFormSet(request.POST, queryset=OrderItem.objects.filter(order=request.order))
+        order = get_or_create_open_order(request)
+        order_form = EditOrderForm(request.POST, instance=order)
+        order_items_formset = OrderItemFormSet(request.POST, queryset=self.get_order_items(order))
         if order_form.is_valid() and order_items_formset.is_valid():
             order_form.save()
             order_items_formset.save()
+            order.update_totals()
             if order_items_formset.deleted_objects:
-                order_items_formset = OrderItemFormSet(queryset=OrderItem.objects.filter(order=request.order))
+                order_items_formset = OrderItemFormSet(queryset=self.get_order_items(order))
             if request.POST.get("send") == "true":
-                if hasattr(request, "order"):
-                    order = request.order
-                    order.is_closed = True
-                    order.save()
-                    send_order_email.delay_on_commit(order.id)
+                order.is_closed = True
+                order.save()
+                send_order_email.delay_on_commit(order.id)
                 logout(request)
                 return HttpResponseRedirect(reverse("commercial_order_complite"))
         context = {
-            "order": request.order,
+            "order": order,
             "form": order_form,
             "order_items_formset": order_items_formset,
             "debts": UserDebs.objects.filter(user=request.user),
@@ -451,32 +524,57 @@ class DownloadArticleImages(ActiveRequiredMixin, View):
         return FileResponse(buffer, as_attachment=True, filename=f"{article_id}.zip")
 
 
+def accepts_gzip(request) -> bool:
+    codings = {}
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        coding, *params = item.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name.lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        codings[coding.strip().lower()] = quality
+    # "gzip;q=0" refuses gzip, "*" covers it only when gzip is not listed
+    return codings.get("gzip", codings.get("x-gzip", codings.get("*", 0.0))) > 0
+
+
 class ExportToXML(View):
+    build_key = "xml-feed-build:{departament_id}"
+    build_timeout = 60 * 10
+
     def get(self, request, *args, **kwargs):
         country = self.kwargs.get("country").upper() if "country" in self.kwargs else None
-        departament = get_object_or_404(Departament, country=country)
-        buffer = io.BytesIO()
-        tree = export_department_to_xml(departament)
-
-        tree.write(buffer, encoding="utf-8")
-        buffer.seek(0)
-        return HttpResponse(buffer, content_type="text/xml")
+        departament = get_object_or_404(Departament.objects.select_related("xml_feed"), country=country)
+        feed = getattr(departament, "xml_feed", None)
+        if feed is None:
+            # pollers of a new departament sharing a cache queue the first build once,
+            # build_xml_feed serialises any other builds on its advisory lock
+            if cache.add(self.build_key.format(departament_id=departament.id), True, self.build_timeout):
+                build_xml_feed.delay(departament.id)
+            return StreamingHttpResponse(export_department_to_xml(departament), content_type="text/xml")
+
+        gzip = accepts_gzip(request)
+        # each encoding is its own representation and needs its own strong validator
+        etag = quote_etag(f"{feed.etag}-gzip" if gzip else feed.etag)
+        last_modified = int(feed.generated_at.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = StreamingHttpResponse(read_xml_feed(feed, decompress=not gzip), content_type="text/xml")
+            if gzip:
+                response["Content-Encoding"] = "gzip"
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        patch_vary_headers(response, ("Accept-Encoding",))
+        return response
 
 
 class ArticleNameAutocompleteView(ActiveRequiredMixin, View):
     def get(self, request, *args, **kwargs):
-        queryset = (
-            ArticleProperties.objects.filter(
-                name__search=request.GET.get("term"),
-                # departament=request.user.profile.departament,
-            )
-            .values("name", "article_id")
-            .distinct()
-        )
-        return JsonResponse(
-            [{"label": i['name'], "value": i['name']} for i in queryset],
-            safe=False,
-        )
+        names = autocomplete_names(request.user.profile.departament, request.GET.get("term", "").strip())
+        return JsonResponse([{"label": name, "value": name} for name in names], safe=False)
 
 
 class LatestComplaintsJSONView(ListView):